@@ -1,32 +1,186 @@
-import spacy
+import array
+import asyncio
+import atexit
+import html
 import re
-from emot.emo_unicode import EMOTICONS, UNICODE_EMO
 from unidecode import unidecode
 import functools
-from toolz import compose
-import contractions
+import gc
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from toolz import compose, concat, partition_all
 
-#Package discovery and resource access: https://setuptools.readthedocs.io/en/latest/pkg_resources.html
-import pkg_resources
+# SpaCy, emot, contractions, symspellpy and pkg_resources are slow to
+# import, so they are only imported when first needed.
 
 # Spell checking
-from symspellpy import SymSpell, Verbosity 
-sym_spell = SymSpell()
+sym_spell = None
 
-def load_sym_spell_dict():
+def load_sym_spell_dict(snapshot_path=None):
     """
-    This function loads the dictionary for the spell-corrector. 
-    max edit distance is 2.
+    This function loads the dictionary for the spell-corrector, once per
+    process. max edit distance is 2.
+
+    :snapshot_path: optional path of a pickled snapshot of the loaded
+    dictionary. It is loaded if it exists, which is much faster than
+    parsing the frequency file, and written after parsing otherwise.
+    :return: the loaded SymSpell object.
     """
-    dictionary_path = pkg_resources.resource_filename(
-    "symspellpy", "frequency_dictionary_en_82_765.txt")
-    sym_spell.load_dictionary(dictionary_path, 0, 1)
+    global sym_spell
+    snapshot_exists = snapshot_path != None and os.path.exists(snapshot_path)
+    if sym_spell == None:
+        from symspellpy import SymSpell
+        spell = SymSpell()
+        if snapshot_exists:
+            spell.load_pickle(snapshot_path)
+        else:
+            #Package discovery and resource access: https://setuptools.readthedocs.io/en/latest/pkg_resources.html
+            import pkg_resources
+            dictionary_path = pkg_resources.resource_filename(
+            "symspellpy", "frequency_dictionary_en_82_765.txt")
+            spell.load_dictionary(dictionary_path, 0, 1)
+        sym_spell = spell
+    if snapshot_path != None and not snapshot_exists:
+        sym_spell.save_pickle(snapshot_path)
+    return sym_spell
 
 def correct_spelling(text):
     """
     This function attempts to correct the spelling of a string using Symspell.
     """
-    return sym_spell.lookup_compound(text, max_edit_distance=2, transfer_casing=True, ignore_non_words=True)[0].term
+    return load_sym_spell_dict().lookup_compound(text, max_edit_distance=2, transfer_casing=True, ignore_non_words=True)[0].term
+
+# Any run of letters, not just ASCII ones, so words like 'café' are
+# looked up whole rather than in pieces
+WORD_PATTERN = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)*")
+
+# How often correct_spelling_tokens took each path, counting every
+# occurrence of a word rather than every unique word.
+spelling_stats = {'in_vocabulary': 0, 'non_word': 0, 'lookup': 0, 'compound': 0}
+
+@functools.lru_cache(maxsize=100000)
+def _correct_word(word, compound_fallback):
+    """
+    Corrects a single out-of-vocabulary word, memoised across the corpus.
+
+    :return: (corrected word, 'lookup' or 'compound' for the path taken)
+    """
+    from symspellpy import Verbosity
+    suggestions = load_sym_spell_dict().lookup(word, Verbosity.TOP, max_edit_distance=2, transfer_casing=True)
+    if suggestions:
+        return suggestions[0].term, 'lookup'
+    if compound_fallback:
+        return correct_spelling(word), 'compound'
+    return word, 'lookup'
+
+def correct_spelling_tokens(text, compound_fallback=True):
+    """
+    Attempts to correct the spelling of a string one word at a time.
+    Words already in the dictionary are left alone and only unknown words
+    are looked up, with the results memoised. Contractions count as
+    known when the word before the apostrophe is (e.g. "they've"). Like
+    lookup_compound with ignore_non_words, acronyms (e.g. 'AWS') are left
+    alone too. Unlike correct_spelling, punctuation and spacing are kept
+    as they are.
+
+    :text: string that we would like to correct.
+    :compound_fallback: whether to try lookup_compound on words with no
+    single-word suggestion (e.g. joined words like 'somethingcaroline').
+    :return: corrected string
+    """
+    words = load_sym_spell_dict().words
+    def correct(match):
+        word = match.group(0)
+        if word.lower() in words or word.split("'")[0].lower() in words:
+            spelling_stats['in_vocabulary'] += 1
+            return word
+        if len(word) > 1 and word.isupper():
+            spelling_stats['non_word'] += 1
+            return word
+        corrected, path = _correct_word(word, compound_fallback)
+        spelling_stats[path] += 1
+        return corrected
+    return WORD_PATTERN.sub(correct, text)
+
+def spelling_cache_info():
+    """
+    Reports how often correct_spelling_tokens hit the dictionary fast path
+    versus a full lookup.
+
+    :return: dictionary of path counts per word occurrence, plus the memo
+    cache hits and misses.
+    """
+    info = _correct_word.cache_info()
+    return dict(spelling_stats, memo_hits=info.hits, memo_misses=info.misses)
+
+# A tag starts with a letter, '/', '!' (e.g. doctypes) or '?' and can't
+# contain another '<', so a failed match never scans past the next '<'.
+TAG_PATTERN = re.compile(r'</?[A-Za-z!?][^<>]*>')
+RAW_TEXT_TAG_PATTERN = re.compile(r'<(script|style)\b', re.IGNORECASE)
+# Searched in the original string, as lower casing can change its length
+RAW_TEXT_END_PATTERNS = {name: re.compile('</' + name, re.IGNORECASE | re.ASCII) \
+    for name in ('script', 'style')}
+# Tags that break a line when rendered, so the words either side of them
+# are separate words. Inline tags (e.g. <b>) can sit inside a word.
+BLOCK_TAG_PATTERN = re.compile(r'</?(?:address|article|aside|blockquote|br|dd|div|dl|dt'
+    r'|fieldset|figcaption|figure|footer|form|h[1-6]|header|hr|li|main|nav|ol|p|pre'
+    r'|section|table|tbody|td|tfoot|th|thead|tr|ul)(?![A-Za-z0-9])', re.IGNORECASE)
+
+def html_to_text(utterance):
+    """
+    Strips HTML from a string in a single linear pass. Tags and comments
+    are dropped, the contents of script and style elements are dropped,
+    and entities like &amp; are decoded. A '<' that doesn't start a tag
+    (e.g. '<3') is kept as text. Block tags like </p><p> leave a space
+    where the words either side would otherwise be joined, while inline
+    tags like <b> leave nothing.
+
+    :utterance: string that we would like to clean.
+    :return: cleanned string
+    """
+    text = []
+    position = 0
+    separate = False
+    while True:
+        start = utterance.find('<', position)
+        chunk = utterance[position:start] if start != -1 else utterance[position:]
+        if chunk:
+            if separate and text and not text[-1][-1].isspace() and not chunk[0].isspace():
+                text.append(' ')
+            text.append(chunk)
+            separate = False
+        if start == -1:
+            break
+        if utterance.startswith('<!--', start):
+            end = utterance.find('-->', start + 4)
+            if end == -1: # Unterminated comments run to the end
+                break
+            position = end + 3
+            continue
+        tag = TAG_PATTERN.match(utterance, start)
+        if tag == None:
+            text.append('<')
+            position = start + 1
+            continue
+        position = tag.end()
+        separate = separate or BLOCK_TAG_PATTERN.match(tag.group(0)) != None
+        raw_text = RAW_TEXT_TAG_PATTERN.match(tag.group(0))
+        if raw_text != None and not tag.group(0).endswith('/>'):
+            end = RAW_TEXT_END_PATTERNS[raw_text.group(1).lower()].search(utterance, position)
+            if end == None: # Unclosed script or style runs to the end
+                break
+            position = end.start()
+    return html.unescape(''.join(text))
 
 def remove_html_tags(utterance):
     """
@@ -35,8 +189,9 @@ def remove_html_tags(utterance):
     :utterance: string that we would like to clean.
     :return: cleanned string
     """
-    clean = re.compile('<.*?>')
-    return re.sub(clean, '', utterance)
+    if '<' not in utterance and '&' not in utterance:
+        return utterance
+    return html_to_text(utterance)
 
 def remove_excess_whitespace(utterance):
     """
@@ -47,6 +202,18 @@ def remove_excess_whitespace(utterance):
     """
     return " ".join(utterance.split())
 
+def remove_html_and_whitespace(utterance):
+    """
+    Strips HTML and collapses whitespace in one step, giving the same
+    result as remove_html_tags followed by remove_excess_whitespace.
+
+    :utterance: string that we would like to clean.
+    :return: cleanned string
+    """
+    if '<' in utterance or '&' in utterance:
+        utterance = html_to_text(utterance)
+    return " ".join(utterance.split())
+
 def convert_non_ascii(utterance):
     """
     Try to convert non-ASCII characters to something readable in
@@ -55,6 +222,8 @@ def convert_non_ascii(utterance):
     :utterance: string that we would like to clean.
     :return: cleanned string
     """
+    if utterance.isascii():
+        return utterance
     return unidecode(utterance)
 
 def remove_stop_words(utterance):
@@ -86,6 +255,19 @@ def remove_entity(utterance, entities):
     """
     return [token for token in utterance if token.ent_type_ not in entities]
 
+def norm_entity_token(token, entities):
+    """
+    Normalises a single token to its entity name if it is one of the
+    chosen entities.
+
+    :token: a SpaCy token or string
+    :entities: the collection of entity names you want to normalise
+    :return: the entity name, or the token unchanged.
+    """
+    if not isinstance(token, str) and token.ent_type_ in entities:
+        return token.ent_type_
+    return token
+
 def norm_entity(utterance, entities):
     """
     Normalises chosen entities to a standard string representation.
@@ -95,13 +277,16 @@ def norm_entity(utterance, entities):
     :entities: the list of entity names you want to normalise
     :return: list of SpaCy tokens after normalisation
     """
-    norm_tokens = []
-    for token in utterance:
-        if not isinstance(token, str) and token.ent_type_ in entities:
-            norm_tokens.append(token.ent_type_)
-        else:
-            norm_tokens.append(token)
-    return norm_tokens
+    return [norm_entity_token(token, entities) for token in utterance]
+
+def lemmatise_token(token):
+    """
+    Returns a single token to its lemma.
+
+    :token: a SpaCy token or string
+    :return: the lemma string, or the token unchanged if it is already a string.
+    """
+    return token if isinstance(token, str) else token.lemma_
 
 def lemmatise(utterance):
     """
@@ -110,8 +295,7 @@ def lemmatise(utterance):
     :utterance: a SpaCy doc object (https://spacy.io/api/doc) or list of tokens
     :return: a list of string tokens that have been returned to their lemma.
     """
-    return [token.lemma_ if isinstance(token, spacy.tokens.token.Token) \
-        else token for token in utterance]
+    return list(map(lemmatise_token, utterance))
 
 def remove_dependency(utterance, dep):
     """
@@ -143,7 +327,95 @@ def split_contractions(utterance):
     :utterance: phrase in a string.
     :return: expanded utterance with no contractions.
     """
-    return contractions.fix(utterance)
+    return expand_contractions(utterance)
+
+def split_standard_contractions(utterance):
+    """
+    Like split_contractions, but leaves slang (e.g. wanna, dont) alone,
+    so utterances without apostrophes are only checked for abbreviations
+    like 'jan.' rather than searched with a regex.
+
+    :utterance: phrase in a string.
+    :return: expanded utterance with no standard contractions.
+    """
+    return expand_contractions(utterance, leftovers=False, slang=False)
+
+def _char_class(chars):
+    """
+    Builds a regex character class that matches any of the given
+    characters, merging consecutive code points into ranges so large
+    (non-BMP) sets still match quickly.
+
+    :chars: iterable of single characters.
+    :return: character class as a regex string.
+    """
+    ranges = []
+    for point in sorted(set(map(ord, chars))):
+        if ranges and ranges[-1][1] == point - 1:
+            ranges[-1][1] = point
+        else:
+            ranges.append([point, point])
+    return '[' + ''.join(re.escape(chr(low)) if low == high \
+        else re.escape(chr(low)) + '-' + re.escape(chr(high)) for low, high in ranges) + ']'
+
+def _trie_pattern(keys):
+    """
+    Builds a regex from a trie of the literal keys, so shared prefixes
+    are only tested once and the longest key at a position wins.
+
+    :keys: iterable of literal strings.
+    :return: regex string matching any of the keys.
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def node_pattern(node):
+        terminal = '' in node
+        branches = [re.escape(char) + node_pattern(child) \
+            for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and not terminal:
+            return branches[0]
+        pattern = '(?:' + '|'.join(branches) + ')'
+        return pattern + '?' if terminal else pattern
+
+    return node_pattern(trie)
+
+def build_replacer(table):
+    """
+    Compiles a table of literal substrings into a function that swaps
+    every key for its value in a single pass over a string.
+    Where keys overlap, the longest one wins.
+
+    :table: dictionary mapping substrings to their replacements.
+    :return: function taking a string and returning the replaced string.
+    """
+    pattern = re.compile('(?=' + _char_class(key[0] for key in table) + ')' \
+        + _trie_pattern(table))
+    return functools.partial(pattern.sub, lambda match: table[match.group(0)])
+
+@functools.lru_cache(maxsize=None)
+def emoticon_replacer():
+    """
+    Returns the compiled emoticon replacer, building it on first use.
+    """
+    from emot.emo_unicode import EMOTICONS
+    return build_replacer({emot: " ".join(EMOTICONS[emot].replace(",","").replace(":","").split()) \
+        for emot in EMOTICONS})
+
+@functools.lru_cache(maxsize=None)
+def emoji_replacer():
+    """
+    Returns the compiled emoji replacer, building it on first use.
+    """
+    from emot.emo_unicode import UNICODE_EMO
+    return build_replacer({emot: " ".join(UNICODE_EMO[emot].replace(",","").replace(":","").replace('_', ' ').split()) \
+        for emot in UNICODE_EMO})
 
 def convert_emoticons(utterance):
     """
@@ -152,9 +424,7 @@ def convert_emoticons(utterance):
     :utterance: phrase in a string.
     :return: expanded utterance with no emoticons.
     """
-    for emot in EMOTICONS:
-        utterance = utterance.replace(emot, " ".join(EMOTICONS[emot].replace(",","").replace(":","").split()))
-    return utterance
+    return emoticon_replacer()(utterance)
 
 def convert_emojis(utterance):
     """
@@ -163,132 +433,2145 @@ def convert_emojis(utterance):
     :utterance: phrase in a string.
     :return: expanded utterance with no emojis.
     """
-    for emot in UNICODE_EMO:
-        utterance = utterance.replace(emot, " ".join(UNICODE_EMO[emot].replace(",","").replace(":","").replace('_', ' ').split()))
-    return utterance
+    # Every emoji contains a non-ASCII character, so plain ASCII text can be skipped.
+    if utterance.isascii():
+        return utterance
+    return emoji_replacer()(utterance)
 
 
-class TextPreprocessing():
 
-    def __init__(self, utterances, pipes = ['entity_ruler', 'sentencizer']) -> None:
-        self.raw_utterances = utterances
-        self.cleaned_utterances = self.raw_utterances
-        self.nlp_utterances = None
+APOSTROPHES = "'\u2019\u2018`\u00b4\u02bc"
+APOSTROPHE_PATTERN = re.compile('[' + re.escape(APOSTROPHES) + ']')
+# Contractions only match as whole words, as in the contractions library.
+WORD_CHARS = 'A-Za-z0-9_'
+ASCII_WORD_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+ABBREVIATION_PATTERN = re.compile('[' + WORD_CHARS + ']+\\.')
 
-        # Load SpaCy model
-        self.nlp = spacy.load('en_core_web_sm')
-        # Load SpaCy pipeline 
-        if pipes != None:
-            self.load_nlp_pipe(pipes)
-        
-    # Load NLP pipeline
-    def load_nlp_pipe(self, pipes):
+def _word_pattern(keys):
+    return '(?<![' + WORD_CHARS + '])(?=' + _char_class(key[0] for key in keys) + ')' \
+        + '(?:' + _trie_pattern(keys) + ')(?![' + WORD_CHARS + '])'
+
+@functools.lru_cache(maxsize=None)
+def contraction_matcher(leftovers=True, slang=True):
+    """
+    Compiles the contractions library's tables into regexes, building
+    them on first use. Text without apostrophes can only hold the keys
+    written without one, so those get their own pattern. When they are
+    all abbreviations ending in a full stop, as without leftovers and
+    slang ('jan.', 'feb.', ...), they are looked up directly instead.
+
+    :leftovers: whether to include leftovers like 'whats'.
+    :slang: whether to include slang like 'wanna' and 'u'.
+    :return: (pattern for every key, lower case table, pattern for the
+    keys without apostrophes, whether those are all abbreviations)
+    """
+    import contractions
+    tables = [contractions.contractions_dict]
+    if leftovers:
+        tables.append(contractions.leftovers_dict)
+    if slang:
+        tables.append(contractions.slang_dict)
+    table = {}
+    for contraction_table in tables:
+        for contraction, expansion in contraction_table.items():
+            table[contraction.lower()] = expansion
+    pattern = re.compile(_word_pattern(table))
+    unmarked = [key for key in table if not APOSTROPHE_PATTERN.search(key)]
+    unmarked_pattern = re.compile(_word_pattern(unmarked)) if unmarked else None
+    abbreviations = all(ABBREVIATION_PATTERN.fullmatch(key) for key in unmarked)
+    return pattern, table, unmarked_pattern, abbreviations
+
+def _abbreviation_matches(utterance, table):
+    # Looks up the word in front of each full stop, as _word_pattern would match it
+    end = utterance.find('.')
+    while end != -1:
+        start = end
+        while start > 0 and utterance[start - 1] in ASCII_WORD_CHARS:
+            start -= 1
+        key = utterance[start:end + 1].lower()
+        if start < end and key in table \
+            and (end + 1 == len(utterance) or utterance[end + 1] not in ASCII_WORD_CHARS):
+            yield start, end + 1, key
+        end = utterance.find('.', end + 1)
+
+def _lower_in_place(utterance):
+    # Keeps characters whose lower case is longer so offsets still line up
+    return ''.join(char if len(char.lower()) != 1 else char.lower() for char in utterance)
+
+def _match_case(expansion, contraction):
+    if len(contraction) > 1 and contraction.isupper():
+        return expansion.upper()
+    if contraction[:1].isupper():
+        return expansion[:1].upper() + expansion[1:]
+    return expansion
+
+def expand_contractions(utterance, leftovers=True, slang=True, preserve_case=False):
+    """
+    Replaces contractions with their full counterparts in a single pass,
+    giving the same output as contractions.fix. Utterances without
+    apostrophes are only searched for the contractions written without
+    one. Without leftovers and slang those are just abbreviations like
+    'jan.', so such utterances never go through a regex.
+
+    :utterance: phrase in a string.
+    :leftovers: whether to expand leftovers like 'whats'.
+    :slang: whether to expand slang like 'wanna' and 'u'.
+    :preserve_case: whether expansions take the case of the contraction
+    (e.g. "DON'T" becomes 'DO NOT' rather than 'do not').
+    :return: expanded utterance with no contractions.
+    """
+    pattern, table, unmarked_pattern, abbreviations = contraction_matcher(leftovers, slang)
+    if APOSTROPHE_PATTERN.search(utterance):
+        matches = None
+    elif abbreviations:
+        matches = _abbreviation_matches(utterance, table)
+    else:
+        pattern = unmarked_pattern
+        matches = None
+    if matches == None:
+        lowered = utterance.lower()
+        if len(lowered) != len(utterance):
+            lowered = _lower_in_place(utterance)
+        matches = ((match.start(), match.end(), match.group(0)) for match in pattern.finditer(lowered))
+
+    expanded = []
+    position = 0
+    for start, end, key in matches:
+        expansion = table[key]
+        if preserve_case:
+            expansion = _match_case(expansion, utterance[start:end])
+        expanded.append(utterance[position:start])
+        expanded.append(expansion)
+        position = end
+    if not expanded:
+        return utterance
+    expanded.append(utterance[position:])
+    return ''.join(expanded)
+
+def expand_contractions_batch(utterances, leftovers=True, slang=True, preserve_case=False):
+    """
+    Expands the contractions of many utterances with one compiled matcher.
+
+    :utterances: iterable of strings.
+    :return: list of expanded utterances.
+    """
+    expand = functools.partial(expand_contractions,
+        leftovers=leftovers, slang=slang, preserve_case=preserve_case)
+    return list(map(expand, utterances))
+
+def count_words(utterance):
+    return len(utterance.split())
+
+class StageProfiler():
+    """
+    Opt-in instrumentation for TextPreprocessing. Records wall time, call
+    count and tokens in and out for every step the processor runs, and
+    passes each stage's totals to the registered callbacks.
+
+    Callbacks are called as callback(step, record) once per step each
+    time a stage (e.g. clean_text) finishes, where record is a dictionary
+    with 'seconds', 'calls', 'tokens_in' and 'tokens_out'.
+    """
+
+    def __init__(self, callbacks=None) -> None:
+        self.totals = {}
+        self.pending = {}
+        self.callbacks = list(callbacks) if callbacks != None else []
+
+    def add_callback(self, callback):
+        """
+        Registers a callback, e.g. a metrics exporter.
         """
-        This function creates and loads all the pipes into the nlp-er
+        self.callbacks.append(callback)
 
-        :pipes: list of pipe names as strings
+    def add(self, step, seconds, tokens_in, tokens_out, calls=1):
+        """
+        Records a run of a step until the next flush.
         """
+        record = self.pending.setdefault(step, \
+            {'seconds': 0.0, 'calls': 0, 'tokens_in': 0, 'tokens_out': 0})
+        record['seconds'] += seconds
+        record['calls'] += calls
+        record['tokens_in'] += tokens_in
+        record['tokens_out'] += tokens_out
 
-        for pipe in pipes:
-            nlp_pipe = self.nlp.create_pipe(pipe)
-            if pipe == 'sentencizer': #needs to go before the parser. 
-                self.nlp.add_pipe(nlp_pipe, before='parser')
-            else:
-                self.nlp.add_pipe(nlp_pipe)
+    def wrap(self, function, step=None, count=count_words):
+        """
+        Wraps a single-utterance function so each call is recorded.
 
-    def clean_text(self,
-        drop_excess_whitespace=True,
-        drop_html=True,
-        clean_ascii=True):
+        :function: the function to time.
+        :step: name to record it under. Defaults to the function's name.
+        :count: function counting the tokens in an input or output.
+        :return: the timed function.
         """
-        Removes excess whitespace, HTML tags, and transliterates
-        non-ASCII characters. 
+        step = function.__name__ if step == None else step
+        def timed(utterance):
+            start = time.perf_counter()
+            result = function(utterance)
+            self.add(step, time.perf_counter() - start, count(utterance), count(result))
+            return result
+        return timed
+
+    def flush(self):
+        """
+        Adds the pending records to the totals and passes them to the callbacks.
         """
-        if drop_excess_whitespace: 
-            self.cleaned_utterances = list(map(remove_excess_whitespace, self.cleaned_utterances))
-        if drop_html: 
-            self.cleaned_utterances = list(map(remove_html_tags, self.cleaned_utterances))
-        if clean_ascii: 
-            self.cleaned_utterances = list(map(convert_non_ascii, self.cleaned_utterances))
+        pending, self.pending = self.pending, {}
+        for step, record in pending.items():
+            total = self.totals.setdefault(step, \
+                {'seconds': 0.0, 'calls': 0, 'tokens_in': 0, 'tokens_out': 0})
+            for field, value in record.items():
+                total[field] += value
+            for callback in self.callbacks:
+                callback(step, record)
 
-    def normalise_text(self,
-        fix_spelling=False,
-        normalise_contractions=True,
-        normalise_emojis=True,
-        norm_ents=None,
-        lemma=True):
+    def reset(self):
         """
-        Fixes spelling, splits contractions, converts emojis, 
-        normalises entities, and lemmatises.
+        Clears the recorded totals.
         """
-        if fix_spelling:
-            self.cleaned_utterances = list(map(correct_spelling, self.cleaned_utterances))
-        if normalise_contractions:
-            self.cleaned_utterances = list(map(split_contractions, self.cleaned_utterances))
-        if normalise_emojis:
-            self.cleaned_utterances = list(map(convert_emoticons, self.cleaned_utterances))
-            self.cleaned_utterances = list(map(convert_emojis, self.cleaned_utterances))
+        self.totals = {}
+        self.pending = {}
 
-        if self.nlp_utterances == None:
-             self.nlp_utterances = list(self.nlp.pipe(self.cleaned_utterances))
-            
-        if norm_ents != None:
-            self.nlp_utterances = list(map(lambda utterance: \
-                norm_entity(utterance, norm_ents), self.nlp_utterances))
+def log_stage(step, record, logger=logging.getLogger(__name__)):
+    """
+    StageProfiler callback that logs each step's record at debug level.
+    """
+    logger.debug('%s: %d calls in %.4fs, %d tokens in, %d tokens out', step,
+        record['calls'], record['seconds'], record['tokens_in'], record['tokens_out'])
+
+def fuse(steps, profiler=None):
+    """
+    Fuses a list of single-utterance steps into one callable that applies
+    them in order, so each utterance is only visited once.
+
+    :steps: list of functions, applied first to last.
+    :profiler: optional StageProfiler to record each step with.
+    :return: the fused function, or None if there are no steps.
+    """
+    if profiler != None:
+        steps = [profiler.wrap(step) for step in steps]
+    return compose(*reversed(steps)) if steps else None
+
+def text_cleaner(drop_excess_whitespace=True,
+    drop_html=True,
+    clean_ascii=True,
+    profiler=None):
+    """
+    Builds the fused string function for the chosen clean_text steps.
+
+    :profiler: optional StageProfiler to record each step with.
+    :return: function taking and returning a string, or None.
+    """
+    steps = []
+    if drop_excess_whitespace and drop_html:
+        steps.append(remove_html_and_whitespace)
+    elif drop_excess_whitespace:
+        steps.append(remove_excess_whitespace)
+    elif drop_html:
+        steps.append(remove_html_tags)
+    if clean_ascii:
+        steps.append(convert_non_ascii)
+    return fuse(steps, profiler)
+
+def text_normaliser(fix_spelling=False,
+    normalise_contractions=True,
+    normalise_emojis=True,
+    spelling_mode='compound',
+    profiler=None,
+    contraction_slang=True):
+    """
+    Builds the fused string function for the chosen normalise_text steps
+    that run before SpaCy.
+
+    :spelling_mode: 'compound' to correct whole utterances with
+    correct_spelling, or 'tokens' to correct unknown words only with
+    correct_spelling_tokens.
+    :contraction_slang: whether to expand slang contractions too. Without
+    them, split_standard_contractions skips utterances with no apostrophes.
+    :profiler: optional StageProfiler to record each step with.
+    :return: function taking and returning a string, or None.
+    """
+    steps = []
+    if fix_spelling:
+        steps.append(correct_spelling_tokens if spelling_mode == 'tokens' else correct_spelling)
+    if normalise_contractions:
+        steps.append(split_contractions if contraction_slang else split_standard_contractions)
+    if normalise_emojis:
+        steps.extend([convert_emoticons, convert_emojis])
+    return fuse(steps, profiler)
+
+class TokenNormaliser():
+    """
+    Fused per-token entity normalisation and lemmatisation. Whole SpaCy
+    docs can instead be normalised in bulk with apply(), which reads the
+    entity types and lemmas for the doc in one Doc.to_array call.
+    """
+
+    def __init__(self, norm_ents=None, lemma=True) -> None:
+        self.norm_ents = frozenset(norm_ents) if norm_ents != None else None
+        self.lemma = lemma
+        self.config = ('normalise', self.norm_ents, lemma)
+        steps = []
+        if self.norm_ents != None:
+            steps.append(functools.partial(norm_entity_token, entities=self.norm_ents))
         if lemma:
-            self.nlp_utterances = list(map(lemmatise, self.nlp_utterances))
+            steps.append(lemmatise_token)
+        self.normalise = fuse(steps)
 
-    def filter_text(self, 
-        drop_stop_words=True,
-        drop_punctuation=True,
-        drop_pos = None,
-        drop_dep = None,
-        drop_ent = None):
+    def __call__(self, token):
+        return self.normalise(token)
+
+    def apply(self, doc, indices):
         """
-        Removes punctuation, stopwords, pos, dep, and or entities.
+        Normalises the chosen tokens of a doc.
+
+        :doc: a SpaCy doc object (https://spacy.io/api/doc)
+        :indices: sequence of the positions of the tokens to keep
+        :return: list of normalised tokens.
         """
-        if self.nlp_utterances == None:
-            self.nlp_utterances = list(self.nlp.pipe(self.cleaned_utterances))
-        
+        from spacy.attrs import ENT_TYPE, LEMMA
+        strings = doc.vocab.strings
+        values = doc.to_array([ENT_TYPE, LEMMA]).tolist()
+        norm_ids = {strings[entity] for entity in self.norm_ents} \
+            if self.norm_ents != None else set()
+        normalised = []
+        for index in indices:
+            ent_type, lemma = values[index]
+            if ent_type in norm_ids:
+                normalised.append(strings[ent_type])
+            elif self.lemma and lemma == 0:
+                # No tagger set a lemma, so fall back to the lookup lemma
+                normalised.append(doc[index].lemma_)
+            elif self.lemma:
+                normalised.append(strings[lemma])
+            else:
+                normalised.append(doc[index])
+        return normalised
+
+def token_normaliser(norm_ents=None, lemma=True):
+    """
+    Builds the fused per-token function for entity normalisation and
+    lemmatisation.
+
+    :norm_ents: the list of entity names you want to normalise
+    :lemma: whether to return tokens to their lemma
+    :return: TokenNormaliser taking and returning a token, or None.
+    """
+    if norm_ents == None and not lemma:
+        return None
+    return TokenNormaliser(norm_ents, lemma)
+
+class TokenFilter():
+    """
+    Predicate that tests a token against all the chosen filters at once.
+    Whole SpaCy docs can instead be filtered in bulk with mask(), which
+    reads every attribute for the doc in one Doc.to_array call and
+    combines the filters as a NumPy boolean mask.
+    """
+
+    def __init__(self, drop_stop_words=True,
+        drop_punctuation=True,
+        drop_pos=None,
+        drop_dep=None,
+        drop_ent=None) -> None:
+        self.drop_stop_words = drop_stop_words
+        self.drop_punctuation = drop_punctuation
+        self.drop_pos = frozenset(drop_pos) if drop_pos != None else None
+        self.drop_dep = frozenset(drop_dep) if drop_dep != None else None
+        self.drop_ent = frozenset(drop_ent) if drop_ent != None else None
+        self.config = ('filter', bool(drop_stop_words), bool(drop_punctuation),
+            self.drop_pos, self.drop_dep, self.drop_ent)
+        self.checks = []
         if drop_stop_words:
-            self.nlp_utterances = list(map(remove_stop_words, self.nlp_utterances))
+            self.checks.append(lambda token: not token.is_stop)
         if drop_punctuation:
-            self.nlp_utterances = list(map(remove_punctuation, self.nlp_utterances))
-        if drop_pos != None:
-            self.nlp_utterances = list(map(lambda utterance: \
-                remove_pos(utterance, drop_pos), self.nlp_utterances))
-        if drop_dep != None:
-            self.nlp_utterances = list(map(lambda utterance: \
-                remove_dependency(utterance, drop_dep), self.nlp_utterances))
-        if drop_ent != None:
-            self.nlp_utterances = list(map(lambda utterance: \
-                remove_entity(utterance, drop_ent), self.nlp_utterances))
-
-    def preprocess(self):
-        """"
-        Cleans, normalises, filters, and finally normalises a set of 
-        utterances. This function takes all the defaults for most 
-        purposes. Strips HTML tags, removes excess whitespace,
-        transliterates non-ASCII characters, converts emojis,
-        expands contractions, fixes spelling, removes stop words,
-        removes punctuation, normalises common entities, and lemmatises
-        words. 
+            self.checks.append(lambda token: token.is_alpha or token.is_digit)
+        if self.drop_pos != None:
+            self.checks.append(lambda token: token.pos_ not in self.drop_pos)
+        if self.drop_dep != None:
+            self.checks.append(lambda token: token.dep_ not in self.drop_dep)
+        if self.drop_ent != None:
+            self.checks.append(lambda token: token.ent_type_ not in self.drop_ent)
+
+    def __call__(self, token):
+        return all(check(token) for check in self.checks)
+
+    def mask(self, doc):
+        """
+        Works out which tokens of a doc to keep.
+
+        :doc: a SpaCy doc object (https://spacy.io/api/doc)
+        :return: NumPy boolean array, True for the tokens to keep.
+        """
+        import numpy as np
+        from spacy.attrs import IS_STOP, IS_ALPHA, IS_DIGIT, POS, DEP, ENT_TYPE
+        strings = doc.vocab.strings
+        values = doc.to_array([IS_STOP, IS_ALPHA, IS_DIGIT, POS, DEP, ENT_TYPE])
+        keep = np.ones(len(doc), dtype=bool)
+        if self.drop_stop_words:
+            keep &= values[:, 0] == 0
+        if self.drop_punctuation:
+            keep &= (values[:, 1] | values[:, 2]) != 0
+        for column, names in ((3, self.drop_pos), (4, self.drop_dep), (5, self.drop_ent)):
+            if names != None:
+                ids = np.array([strings[name] for name in names], dtype=values.dtype)
+                keep &= ~np.isin(values[:, column], ids)
+        return keep
+
+def token_filter(drop_stop_words=True,
+    drop_punctuation=True,
+    drop_pos=None,
+    drop_dep=None,
+    drop_ent=None):
+    """
+    Builds one predicate that tests a token against all the chosen
+    filters, so each token is only tested once.
+
+    :return: TokenFilter taking a SpaCy token and returning True if it
+    should be kept, or None if nothing is filtered.
+    """
+    keep = TokenFilter(drop_stop_words, drop_punctuation, drop_pos, drop_dep, drop_ent)
+    return keep if keep.checks else None
+
+def process_doc(doc, keep=None, normalise=None):
+    """
+    Filters and normalises the tokens of a whole SpaCy doc in bulk.
+
+    :doc: a SpaCy doc object (https://spacy.io/api/doc)
+    :keep: TokenFilter, or None to keep every token
+    :normalise: TokenNormaliser, or None
+    :return: list of processed tokens.
+    """
+    if keep != None:
+        indices = keep.mask(doc).nonzero()[0].tolist()
+    else:
+        indices = range(len(doc))
+    if normalise != None:
+        return normalise.apply(doc, indices)
+    return [doc[index] for index in indices]
+
+def process_tokens(utterance, keep=None, normalise=None):
+    """
+    Filters and normalises the tokens of an utterance in a single pass.
+    Untouched SpaCy docs are processed in bulk with process_doc.
+
+    :utterance: a SpaCy doc object (https://spacy.io/api/doc) or list of tokens
+    :keep: predicate from token_filter, or None to keep every token
+    :normalise: function from token_normaliser, or None
+    :return: list of processed tokens.
+    """
+    if hasattr(utterance, 'to_array') \
+        and (keep == None or isinstance(keep, TokenFilter)) \
+        and (normalise == None or isinstance(normalise, TokenNormaliser)):
+        return process_doc(utterance, keep, normalise)
+    if keep != None and normalise != None:
+        return [normalise(token) for token in utterance if keep(token)]
+    if keep != None:
+        return [token for token in utterance if keep(token)]
+    if normalise != None:
+        return list(map(normalise, utterance))
+    return list(utterance)
+
+
+# Shared SpaCy models, loaded once per process (see load_nlp).
+nlp_registry = {}
+
+def load_nlp(pipes=None, model='en_core_web_sm', gazetteers=None, gazetteer_cache=None,
+    shared=True):
+    """
+    Loads the SpaCy model with the given pipes added. Shared models are
+    kept in nlp_registry and only loaded the first time a combination is
+    asked for, so everyone asking for the same pipes gets the same object
+    and sees any change made to it, e.g. entity ruler patterns.
+
+    :pipes: list of pipe names as strings, or None for the model's defaults
+    :model: name of the SpaCy model to load
+    :gazetteers: optional mapping of entity labels to gazetteer files (see Gazetteer)
+    :gazetteer_cache: directory to cache the compiled gazetteers in, or None
+    :shared: whether to use the shared model, or load a new one for the caller alone
+    :return: SpaCy Language object (https://spacy.io/api/language)
+    """
+    gazetteers = gazetteer_files(gazetteers) if gazetteers else None
+    key = (model, tuple(pipes) if pipes != None else None, gazetteers)
+    if shared and key in nlp_registry:
+        return nlp_registry[key]
+    import spacy
+    nlp = spacy.load(model)
+    if pipes != None:
+        add_nlp_pipes(nlp, pipes)
+    if gazetteers:
+        nlp.add_pipe(Gazetteer.from_files(nlp, gazetteers, gazetteer_cache), name=Gazetteer.name)
+    if shared:
+        nlp_registry[key] = nlp
+    return nlp
+
+def add_nlp_pipes(nlp, pipes):
+    """
+    This function creates and loads all the pipes into the nlp-er
+
+    :nlp: SpaCy Language object
+    :pipes: list of pipe names as strings
+    """
+    for pipe in pipes:
+        nlp_pipe = nlp.create_pipe(pipe)
+        if pipe == 'sentencizer': #needs to go before the parser. 
+            nlp.add_pipe(nlp_pipe, before='parser')
+        else:
+            nlp.add_pipe(nlp_pipe)
+
+
+def gazetteer_files(gazetteers):
+    """
+    :gazetteers: mapping (or pairs) of entity labels to a file path or list of paths.
+    :return: hashable tuple of (label, tuple of paths) pairs, sorted by label.
+    """
+    return tuple(sorted((label, (paths,) if isinstance(paths, str) else tuple(paths)) \
+        for label, paths in dict(gazetteers).items()))
+
+def read_gazetteer(path):
+    """
+    :path: text file with one phrase per line.
+    :return: list of the phrases, without blank lines.
+    """
+    with open(path, encoding='utf-8') as gazetteer_file:
+        return [line.strip() for line in gazetteer_file if line.strip()]
+
+class Gazetteer():
+    """
+    SpaCy pipeline component tagging phrases from large gazetteers (e.g.
+    product names or IDs) as entities. Phrases are matched with a
+    PhraseMatcher, which looks tokens up by hash, so matching costs about
+    the same however many phrases there are, unlike EntityRuler token
+    patterns. Matches replace overlapping entities from the NER, and the
+    tagged tokens can be normalised or removed like any other entity.
+
+    Usage:
+        gazetteer = Gazetteer.from_files(nlp, {'PRODUCT': 'products.txt'}, cache_dir='.cache')
+        nlp.add_pipe(gazetteer, name=Gazetteer.name)
+    """
+
+    name = 'gazetteer'
+
+    def __init__(self, nlp, attr='LOWER') -> None:
+        """
+        :nlp: SpaCy Language object whose vocab and tokenizer to use.
+        :attr: token attribute to match on, 'LOWER' to ignore case or 'ORTH'.
+        """
+        from spacy.matcher import PhraseMatcher
+        self.nlp = nlp
+        self.attr = attr
+        self.matcher = PhraseMatcher(nlp.vocab, attr=attr)
+        # Tokenised phrases by label, kept compactly for saving
+        self.doc_bins = {}
+        # Hash of the files and model the phrases were loaded from, if any
+        self.digest = None
+
+    def __len__(self):
+        return sum(map(len, self.doc_bins.values()))
+
+    def add(self, label, phrases):
+        """
+        Adds phrases to tag with the given entity label.
+
+        :label: entity label, e.g. 'PRODUCT'.
+        :phrases: iterable of strings.
+        """
+        from spacy.tokens import DocBin
+        docs = list(self.nlp.tokenizer.pipe(phrases))
+        self.add_docs(label, docs)
+        doc_bin = self.doc_bins.setdefault(label, DocBin(attrs=['ORTH']))
+        for doc in docs:
+            doc_bin.add(doc)
+
+    def add_docs(self, label, docs):
+        self.matcher.add(label, docs)
+
+    def __call__(self, doc):
+        """
+        Tags the gazetteer phrases in a doc as entities.
+
+        :doc: SpaCy doc object.
+        :return: the same doc.
+        """
+        from spacy.tokens import Span
+        from spacy.util import filter_spans
+        matches = filter_spans([Span(doc, start, end, label=match_id) \
+            for match_id, start, end in self.matcher(doc)])
+        if not matches:
+            return doc
+        tagged = set()
+        for span in matches:
+            tagged.update(range(span.start, span.end))
+        entities = [ent for ent in doc.ents \
+            if not any(index in tagged for index in range(ent.start, ent.end))]
+        doc.ents = sorted(entities + matches, key=lambda span: span.start)
+        return doc
+
+    def to_bytes(self):
+        """
+        :return: the tokenised phrases as msgpack bytes.
+        """
+        import srsly
+        return srsly.msgpack_dumps({
+            'attr': self.attr,
+            'phrases': {label: doc_bin.to_bytes() for label, doc_bin in self.doc_bins.items()},
+        })
+
+    def from_bytes(self, data):
+        """
+        Adds the phrases saved with to_bytes(), without tokenising them again.
+
+        :data: bytes from to_bytes().
+        :return: the gazetteer.
+        """
+        import srsly
+        from spacy.tokens import DocBin
+        saved = srsly.msgpack_loads(data)
+        if saved['attr'] != self.attr:
+            raise ValueError('Gazetteer was saved matching {}, not {}'.format(saved['attr'], self.attr))
+        for label, doc_bin_bytes in saved['phrases'].items():
+            doc_bin = DocBin(attrs=['ORTH']).from_bytes(doc_bin_bytes)
+            self.add_docs(label, list(doc_bin.get_docs(self.nlp.vocab)))
+            self.doc_bins[label] = doc_bin
+        return self
+
+    def to_disk(self, path):
+        with open(path, 'wb') as gazetteer_file:
+            gazetteer_file.write(self.to_bytes())
+
+    def from_disk(self, path):
+        with open(path, 'rb') as gazetteer_file:
+            return self.from_bytes(gazetteer_file.read())
+
+    @classmethod
+    def from_files(cls, nlp, files, cache_dir=None, attr='LOWER'):
+        """
+        Builds a gazetteer from text files with one phrase per line. With
+        a cache_dir, the tokenised phrases are saved there under a hash of
+        the files' contents and the model, and reused while neither changes.
+
+        :nlp: SpaCy Language object.
+        :files: mapping of entity labels to a file path or list of paths.
+        :cache_dir: directory to cache the tokenised phrases in, or None.
+        :attr: token attribute to match on.
+        :return: Gazetteer
+        """
+        files = dict(gazetteer_files(files))
+        gazetteer = cls(nlp, attr)
+        digest = hashlib.sha1(repr((nlp.meta.get('name'), nlp.meta.get('version'), attr)).encode('utf-8'))
+        for label in sorted(files):
+            digest.update(label.encode('utf-8') + b'\0')
+            for path in files[label]:
+                with open(path, 'rb') as gazetteer_file:
+                    digest.update(hashlib.sha1(gazetteer_file.read()).digest())
+        gazetteer.digest = digest.hexdigest()
+        cache_path = None
+        if cache_dir != None:
+            cache_path = os.path.join(cache_dir, 'gazetteer-{}.msgpack'.format(gazetteer.digest))
+            if os.path.exists(cache_path):
+                return gazetteer.from_disk(cache_path)
+
+        for label, paths in files.items():
+            gazetteer.add(label, concat(map(read_gazetteer, paths)))
+        if cache_path != None:
+            os.makedirs(cache_dir, exist_ok=True)
+            gazetteer.to_disk(cache_path)
+        return gazetteer
+
+
+def model_fingerprint(nlp):
+    """
+    Identifies everything about a loaded model that changes its output,
+    for use in cache keys.
+
+    :nlp: SpaCy Language object.
+    :return: tuple of the model's name and versions and the hashes of its
+    gazetteer and entity ruler patterns.
+    """
+    gazetteer = nlp.get_pipe(Gazetteer.name).digest if Gazetteer.name in nlp.pipe_names else None
+    patterns = None
+    if 'entity_ruler' in nlp.pipe_names:
+        # Patterns can be added while the model is loaded, so they are
+        # hashed every time
+        patterns = hashlib.sha1(json.dumps(nlp.get_pipe('entity_ruler').patterns,
+            sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    return (nlp.meta.get('lang'), nlp.meta.get('name'), nlp.meta.get('version'),
+        nlp.meta.get('spacy_version'), tuple(nlp.pipe_names), gazetteer, patterns)
+
+
+# The SpaCy components each stage needs. Stop word and punctuation
+# filtering only need the tokenizer. The sentencizer goes with the parser
+# since it sets the sentence boundaries the parser works within.
+STAGE_PIPES = {
+    'lemma': ['tagger'],
+    'pos': ['tagger'],
+    'dep': ['sentencizer', 'parser'],
+    'ent': ['ner', 'entity_ruler', Gazetteer.name],
+}
+
+def required_pipes(pipe_names,
+    lemma=False,
+    drop_pos=None,
+    drop_dep=None,
+    drop_ent=None,
+    norm_ents=None):
+    """
+    Works out which components of a SpaCy pipeline the chosen stages need.
+    Components this module doesn't know about are always kept.
+
+    :pipe_names: the nlp-er's pipe names, in order
+    :return: list of the pipe names needed, in pipeline order.
+    """
+    needed = set()
+    if lemma:
+        needed.update(STAGE_PIPES['lemma'])
+    if drop_pos != None:
+        needed.update(STAGE_PIPES['pos'])
+    if drop_dep != None:
+        needed.update(STAGE_PIPES['dep'])
+    if drop_ent != None or norm_ents != None:
+        needed.update(STAGE_PIPES['ent'])
+    known = set(concat(STAGE_PIPES.values()))
+    return [name for name in pipe_names if name in needed or name not in known]
+
+
+class ResultCache():
+    """
+    Content-addressed cache of processed utterances. Results are keyed by
+    a hash of the utterance plus the pipeline config, held in a bounded
+    in-memory LRU and, optionally, in an sqlite file that survives
+    restarts. Both tiers hold results as JSON, so every lookup returns a
+    new copy and callers can change it without changing the cache.
+    """
+
+    def __init__(self, max_size=100000, path=None) -> None:
+        """
+        :max_size: maximum number of results held in memory.
+        :path: optional sqlite file for the on-disk tier.
+        """
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if path != None:
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT)')
+
+    @staticmethod
+    def key(utterance, config):
+        """
+        Hashes an utterance together with the pipeline config.
+
+        :utterance: the raw utterance string.
+        :config: any value whose repr identifies the pipeline config.
+        :return: hex digest used as the cache key.
+        """
+        return hashlib.sha1((repr(config) + '\0' + utterance).encode('utf-8')).hexdigest()
+
+    def get(self, key):
         """
-        self.clean_text()
-        self.normalise_text(
-            fix_spelling=True,
-            norm_ents=None,
-            lemma=False)
-        self.filter_text()
-        self.normalise_text(
-            norm_ents=[
-                'PERSON',
-                'DATE',
-                'TIME',
-                'MONEY',
-                'QUANTITY',
-                'ORDINAL',
-                'CARDINAL',
-                'PERCENT',
-            ],
-            lemma=True)
\ No newline at end of file
+        Looks a result up in memory, then on disk.
+
+        :key: cache key from ResultCache.key.
+        :return: the cached result, or None on a miss.
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return json.loads(self.memory[key])
+        if self.db != None:
+            row = self.db.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row != None:
+                self.disk_hits += 1
+                self._remember(key, row[0])
+                return json.loads(row[0])
+        self.misses += 1
+        return None
+
+    def set_many(self, items):
+        """
+        Stores results in memory and, if enabled, on disk.
+
+        :items: list of (key, result) pairs. Results must be JSON serialisable.
+        """
+        self._store([(key, json.dumps(value)) for key, value in items])
+
+    def _store(self, items):
+        for key, encoded in items:
+            self._remember(key, encoded)
+        if self.db != None:
+            with self.db:
+                self.db.executemany('INSERT OR REPLACE INTO results VALUES (?, ?)', items)
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def apply(self, compute, utterances, config):
+        """
+        Returns the results for every utterance, only computing the ones
+        that aren't cached. Duplicates among the misses are computed once.
+
+        :compute: function taking a list of utterances and returning a
+        list of results in the same order.
+        :utterances: sequence of strings.
+        :config: any value whose repr identifies the pipeline config.
+        :return: list of results, in input order.
+        """
+        keys = [self.key(utterance, config) for utterance in utterances]
+        results = [self.get(key) for key in keys]
+        missing = OrderedDict()
+        for key, utterance, result in zip(keys, utterances, results):
+            if result == None:
+                missing.setdefault(key, utterance)
+        if missing:
+            encoded = OrderedDict((key, json.dumps(value)) \
+                for key, value in zip(missing, compute(list(missing.values()))))
+            self._store(list(encoded.items()))
+            # Decoded for every copy, so no two results share lists
+            results = [json.loads(encoded[key]) if result == None else result \
+                for key, result in zip(keys, results)]
+        return results
+
+    def stats(self):
+        """
+        :return: dictionary of hit/miss counts and the overall hit rate.
+        """
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self.memory),
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        """
+        Closes the on-disk tier.
+        """
+        if self.db != None:
+            self.db.close()
+            self.db = None
+
+
+def dedup_key(utterance, clean=None):
+    """
+    Key under which near-exact duplicates are grouped: the cleaned
+    utterance with whitespace collapsed and case folded.
+
+    :utterance: phrase in a string.
+    :clean: cleaning function to apply first. Defaults to text_cleaner().
+    :return: string key.
+    """
+    clean = text_cleaner() if clean == None else clean
+    return ' '.join(clean(utterance).split()).casefold()
+
+def deduplicate(utterances, key=dedup_key):
+    """
+    Groups utterances by key, keeping the first utterance of each group.
+
+    :utterances: list of strings.
+    :key: function giving the key to group an utterance under.
+    :return: (list of unique utterances, list of each utterance's index in it)
+    """
+    first = {}
+    uniques = []
+    positions = []
+    for utterance in utterances:
+        utterance_key = key(utterance)
+        index = first.get(utterance_key)
+        if index == None:
+            index = first[utterance_key] = len(uniques)
+            uniques.append(utterance)
+        positions.append(index)
+    return uniques, positions
+
+# SpaCy's parser and NER need roughly 1GB of temporary memory per
+# 100,000 characters, so each MB of headroom is worth about 100 characters.
+CHARS_PER_MB = 100
+MIN_BATCH_CHARS = 1000
+SENTENCE_END_PATTERN = re.compile(r'[.!?\n]\s')
+
+def current_rss_mb():
+    """
+    :return: the process's current resident set size in MB, or None if unknown.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+def split_text(utterance, max_chars):
+    """
+    Splits a long utterance into pieces of at most max_chars, breaking
+    after the last sentence end, failing that the last whitespace, in
+    each piece.
+
+    :utterance: phrase in a string.
+    :max_chars: longest piece to return.
+    :return: list of strings.
+    """
+    pieces = []
+    while len(utterance) > max_chars:
+        window = utterance[:max_chars]
+        ends = [match.end() for match in SENTENCE_END_PATTERN.finditer(window)]
+        end = ends[-1] if ends else max(window.rfind(' '), window.rfind('\n')) + 1
+        if end <= 0:
+            end = max_chars
+        pieces.append(utterance[:end])
+        utterance = utterance[end:]
+    pieces.append(utterance)
+    return pieces
+
+def char_batches(utterances, max_chars):
+    """
+    Groups utterances into batches holding at most max_chars characters
+    between them. An utterance longer than max_chars gets a batch of its own.
+
+    :utterances: iterable of strings.
+    :max_chars: most characters per batch.
+    :return: generator of lists of strings.
+    """
+    batch = []
+    size = 0
+    for utterance in utterances:
+        if batch and size + len(utterance) > max_chars:
+            yield batch
+            batch = []
+            size = 0
+        batch.append(utterance)
+        size += len(utterance)
+    if batch:
+        yield batch
+
+class TokenArrays():
+    """
+    Compact store for processed utterances: a shared string vocabulary
+    plus flat arrays of token ids and per-utterance offsets (a CSR
+    layout). Utterance i is vocab[token_ids[offsets[i]:offsets[i + 1]]].
+    Unlike lists of SpaCy tokens it keeps no Docs alive, pickles cheaply,
+    and can be saved to and memory-mapped from .npy files. Vectorisers can
+    read the arrays directly, e.g.
+    scipy.sparse.csr_matrix((np.ones(len(token_ids)), token_ids, offsets)).
+    """
+
+    def __init__(self, vocab, token_ids, offsets) -> None:
+        """
+        :vocab: list of token strings, indexed by id.
+        :token_ids: flat integer array of the token ids of every utterance.
+        :offsets: integer array of where each utterance starts in token_ids,
+        plus the total length at the end.
+        """
+        self.vocab = vocab
+        self.token_ids = token_ids
+        self.offsets = offsets
+
+    @classmethod
+    def from_utterances(cls, utterances, vocab=None):
+        """
+        Builds the arrays from processed utterances.
+
+        :utterances: iterable of SpaCy docs, lists of tokens or lists of strings.
+        :vocab: optional existing vocabulary list to extend.
+        :return: TokenArrays
+        """
+        import numpy as np
+        vocab = list(vocab) if vocab != None else []
+        ids = {token: index for index, token in enumerate(vocab)}
+        token_ids = array.array('i')
+        offsets = array.array('q', [0])
+        for utterance in utterances:
+            for token in tokens_to_text(utterance):
+                if token not in ids:
+                    ids[token] = len(vocab)
+                    vocab.append(token)
+                token_ids.append(ids[token])
+            offsets.append(len(token_ids))
+        return cls(vocab, np.frombuffer(token_ids, dtype=np.int32), \
+            np.frombuffer(offsets, dtype=np.int64))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        """
+        :return: utterance index as a list of strings. Negative indices
+        count from the end, as with lists.
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('TokenArrays index out of range')
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return [self.vocab[token_id] for token_id in self.token_ids[start:end]]
+
+    def to_lists(self):
+        """
+        :return: every utterance as a list of strings.
+        """
+        return [self[index] for index in range(len(self))]
+
+    def save(self, directory):
+        """
+        Saves the arrays as .npy files and the vocabulary as JSON.
+
+        :directory: directory to save into. Created if it doesn't exist.
+        """
+        import numpy as np
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'token_ids.npy'), self.token_ids)
+        np.save(os.path.join(directory, 'offsets.npy'), self.offsets)
+        with open(os.path.join(directory, 'vocab.json'), 'w', encoding='utf-8') as vocab_file:
+            json.dump(self.vocab, vocab_file)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Loads arrays saved with save().
+
+        :directory: directory they were saved into.
+        :mmap: whether to memory-map the arrays rather than read them into memory.
+        :return: TokenArrays
+        """
+        import numpy as np
+        mmap_mode = 'r' if mmap else None
+        with open(os.path.join(directory, 'vocab.json'), encoding='utf-8') as vocab_file:
+            vocab = json.load(vocab_file)
+        return cls(vocab,
+            np.load(os.path.join(directory, 'token_ids.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, 'offsets.npy'), mmap_mode=mmap_mode))
+
+
+# Entities preprocess() normalises by default
+NORM_ENTS = ['PERSON', 'DATE', 'TIME', 'MONEY', 'QUANTITY', 'ORDINAL', 'CARDINAL', 'PERCENT']
+
+class PipelineSpec():
+    """
+    Declarative description of which preprocessing steps to run. The
+    defaults are the steps preprocess() runs. Specs are immutable,
+    hashable and picklable, and their repr identifies the config, so
+    they can be used as ResultCache configs. compile() turns a spec into
+    an executable Pipeline, once per process.
+
+    Usage:
+        spec = PipelineSpec.from_yaml('pipeline.yaml')
+        pipeline = spec.compile()
+        pipeline.process(utterances)
+    """
+
+    OPTIONS = OrderedDict([
+        ('model', 'en_core_web_sm'),
+        ('pipes', ('entity_ruler', 'sentencizer')),
+        ('drop_excess_whitespace', True),
+        ('drop_html', True),
+        ('clean_ascii', True),
+        ('fix_spelling', True),
+        ('spelling_mode', 'compound'),
+        ('normalise_contractions', True),
+        ('contraction_slang', True),
+        ('normalise_emojis', True),
+        ('drop_stop_words', True),
+        ('drop_punctuation', True),
+        ('drop_pos', None),
+        ('drop_dep', None),
+        ('drop_ent', None),
+        ('norm_ents', tuple(NORM_ENTS)),
+        ('lemma', True),
+        ('gazetteers', None),
+        ('gazetteer_cache', None),
+    ])
+    # Options holding sets of labels, kept sorted so equal specs have equal reprs
+    LABEL_OPTIONS = ('drop_pos', 'drop_dep', 'drop_ent', 'norm_ents')
+
+    def __init__(self, **options) -> None:
+        unknown = set(options) - set(self.OPTIONS)
+        if unknown:
+            raise ValueError('Unknown pipeline options: {}'.format(', '.join(sorted(unknown))))
+        for name, default in self.OPTIONS.items():
+            value = options.get(name, default)
+            if isinstance(value, str) and (name in self.LABEL_OPTIONS or name == 'pipes'):
+                # A single label or pipe, e.g. drop_ent: PERSON in YAML
+                value = (value,)
+            if value != None and name in self.LABEL_OPTIONS:
+                value = tuple(sorted(set(value)))
+            elif value != None and name == 'pipes':
+                value = tuple(value)
+            elif value != None and name == 'gazetteers':
+                value = gazetteer_files(value)
+            object.__setattr__(self, name, value)
+        if self.spelling_mode not in ('compound', 'tokens'):
+            raise ValueError('Unknown spelling mode: {}'.format(self.spelling_mode))
+        object.__setattr__(self, 'config',
+            tuple((name, getattr(self, name)) for name in self.OPTIONS))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('PipelineSpec is immutable, use replace() to change options')
+
+    def __eq__(self, other):
+        return isinstance(other, PipelineSpec) and self.config == other.config
+
+    def __hash__(self):
+        return hash(self.config)
+
+    def __repr__(self):
+        return 'PipelineSpec({})'.format(', '.join('{}={!r}'.format(name, value) \
+            for name, value in self.config))
+
+    @classmethod
+    def from_dict(cls, options):
+        """
+        :options: dictionary of option names to values. Missing options take their defaults.
+        :return: PipelineSpec
+        """
+        return cls(**options)
+
+    @classmethod
+    def from_yaml(cls, path):
+        """
+        Loads a spec from a YAML file holding a mapping of option names to values.
+
+        :path: YAML file to read.
+        :return: PipelineSpec
+        """
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError('Loading pipeline specs from YAML needs pyyaml: pip install pyyaml')
+        with open(path, encoding='utf-8') as spec_file:
+            return cls.from_dict(yaml.safe_load(spec_file) or {})
+
+    def to_dict(self):
+        """
+        :return: dictionary of every option, with lists for sequences.
+        """
+        options = {name: list(value) if isinstance(value, tuple) else value \
+            for name, value in self.config}
+        if self.gazetteers != None:
+            options['gazetteers'] = {label: list(paths) for label, paths in self.gazetteers}
+        return options
+
+    def replace(self, **options):
+        """
+        :return: a copy of the spec with the given options changed.
+        """
+        return PipelineSpec(**dict(self.to_dict(), **options))
+
+    def text_cleaner(self, profiler=None):
+        """
+        :profiler: optional StageProfiler to record each step with.
+        :return: fused string function for the spec's cleaning steps, or None.
+        """
+        return text_cleaner(self.drop_excess_whitespace, self.drop_html, self.clean_ascii, profiler)
+
+    def text_normaliser(self, profiler=None):
+        """
+        :profiler: optional StageProfiler to record each step with.
+        :return: fused string function for the spec's normalisation steps
+        that run before SpaCy, or None.
+        """
+        return text_normaliser(self.fix_spelling, self.normalise_contractions, self.normalise_emojis,
+            self.spelling_mode, profiler, self.contraction_slang)
+
+    def text_function(self, profiler=None):
+        """
+        Builds the fused string function for the cleaning and normalisation
+        steps that run before SpaCy.
+
+        :profiler: optional StageProfiler to record each step with.
+        :return: function taking and returning a string, or None.
+        """
+        steps = [self.text_cleaner(profiler), self.text_normaliser(profiler)]
+        return fuse([step for step in steps if step != None])
+
+    def token_stages(self):
+        """
+        :return: (TokenFilter or None, TokenNormaliser or None) to run on the docs.
+        """
+        return (token_filter(self.drop_stop_words, self.drop_punctuation,
+                self.drop_pos, self.drop_dep, self.drop_ent),
+            token_normaliser(self.norm_ents, self.lemma))
+
+    def required_pipes(self, pipe_names):
+        """
+        :pipe_names: names of the components in the SpaCy pipeline.
+        :return: the components the spec's token stages need.
+        """
+        return required_pipes(pipe_names, self.lemma,
+            self.drop_pos, self.drop_dep, self.drop_ent, self.norm_ents)
+
+    def compile(self):
+        """
+        :return: the Pipeline for this spec, built the first time it is asked for.
+        """
+        return compile_pipeline(self)
+
+@functools.lru_cache(maxsize=None)
+def compile_pipeline(spec):
+    return Pipeline(spec)
+
+class Pipeline():
+    """
+    Executable plan compiled from a PipelineSpec: the fused string
+    function, token stages and SpaCy model it needs, built once and
+    reused for any number of corpora or single strings. Pipelines pickle
+    as their spec, so each worker process compiles its own.
+
+    The model is the shared one from nlp_registry. It is loaded lazily,
+    the first time the pipeline parses anything or nlp is read, so
+    compiling a spec doesn't load it (or build its gazetteers) on its own.
+    Changes made to it in place reach every pipeline and processor
+    sharing it.
+    """
+
+    def __init__(self, spec) -> None:
+        self.spec = spec
+        self.clean = spec.text_function()
+        # Only the normalisation steps, for text that is already cleaned
+        self.normalise_text = spec.text_normaliser()
+        self.keep, self.normalise = spec.token_stages()
+        self._nlp = None
+        if spec.fix_spelling:
+            load_sym_spell_dict()
+        self.workers = WorkerPool(spec)
+
+    @property
+    def nlp(self):
+        if self._nlp == None:
+            self._nlp = load_nlp(list(self.spec.pipes) if self.spec.pipes != None else None,
+                self.spec.model, self.spec.gazetteers, self.spec.gazetteer_cache)
+        return self._nlp
+
+    @property
+    def disable(self):
+        return [name for name in self.nlp.pipe_names \
+            if name not in self.spec.required_pipes(self.nlp.pipe_names)]
+
+    def __reduce__(self):
+        return (compile_pipeline, (self.spec,))
+
+    def close(self):
+        """
+        Shuts down the pipeline's worker processes, if any were started.
+        Pipelines from compile() are shared and kept for the life of the
+        process, so their workers are otherwise only shut down at exit.
+        The pipeline starts them again if it is used after closing.
+        """
+        self.workers.close()
+
+    def __call__(self, utterance):
+        """
+        :utterance: phrase in a string.
+        :return: the processed utterance as a list of strings.
+        """
+        return next(self.stream([utterance]))
+
+    def cache_config(self):
+        """
+        :return: ResultCache config covering the spec and the loaded model.
+        """
+        return ('pipeline', self.spec, model_fingerprint(self.nlp))
+
+    def stream(self, utterances, batch_size=1000):
+        """
+        Lazily processes any iterable of utterances.
+
+        :utterances: iterable of strings.
+        :batch_size: number of utterances SpaCy parses at a time.
+        :return: generator of processed utterances as lists of strings, in input order.
+        """
+        cleaned = map(self.clean, utterances) if self.clean != None else utterances
+        for doc in self.nlp.pipe(cleaned, disable=self.disable, batch_size=batch_size):
+            yield tokens_to_text(process_tokens(doc, self.keep, self.normalise))
+
+    def process(self, utterances, batch_size=1000, n_process=1, cache=None):
+        """
+        Processes a corpus, optionally across worker processes and through a cache.
+
+        :utterances: sequence of strings.
+        :batch_size: number of utterances parsed, or sent to a worker, at a time.
+        :n_process: number of processes to use (-1 for all cores).
+        :cache: optional ResultCache, keyed on the spec.
+        :return: list of processed utterances as lists of strings, in input order.
+        """
+        if cache != None:
+            return cache.apply(functools.partial(self.process, batch_size=batch_size,
+                n_process=n_process), utterances, self.cache_config())
+        if n_process == -1:
+            n_process = os.cpu_count()
+        if n_process > 1:
+            return [tokens for _, tokens in concat(self.workers.map(utterances, n_process, batch_size))]
+        return list(self.stream(utterances, batch_size))
+
+
+class TextPreprocessing():
+    """
+    Cleans, normalises and filters a list of utterances, either step by
+    step (clean_text, normalise_text, filter_text) or all at once with
+    preprocess().
+
+    Processors with the same pipes share one SpaCy model from
+    nlp_registry, so only the first one pays for loading it. Changes made
+    to a shared model in place, such as adding entity ruler patterns,
+    reach every processor and compiled Pipeline sharing it. Processors
+    that change their model should pass share_model=False to load a
+    model of their own. Worker processes load the model from the spec, so
+    they never see changes made to it in place.
+    """
+
+    def __init__(self, utterances, pipes = ['entity_ruler', 'sentencizer'], n_process=1,
+        cache=None, disable_unused_pipes=True, profiler=None, deduplicate=False,
+        memory_limit=None, long_texts='split', spec=None, keep_docs=False,
+        share_model=True) -> None:
+        self.raw_utterances = utterances
+        self.cleaned_utterances = self.raw_utterances
+        self.nlp_utterances = None
+        # Parsed SpaCy docs behind nlp_utterances, the pipes they were run
+        # through and the cleaned utterances they were parsed from. Unless
+        # keep_docs is set, they are let go once the tokens no longer need
+        # them and at the end of preprocess().
+        self.keep_docs = keep_docs
+        self.docs = None
+        self.enabled_pipes = None
+        self.docs_source = None
+        # Results of the token stages run on the docs, keyed by the configs
+        # of every stage applied so far. Only kept with keep_docs.
+        self.applied_stages = ()
+        self.stage_results = OrderedDict()
+        self.max_stage_results = 8
+        self.disable_unused_pipes = disable_unused_pipes
+        # Steps preprocess() runs. A given spec's pipes and model are used
+        # in place of pipes.
+        self.spec = spec if spec != None else PipelineSpec(pipes=pipes)
+        self.pipes = list(self.spec.pipes) if self.spec.pipes != None else None
+        self.n_process = n_process
+        # Optional ResultCache shared across calls to preprocess()
+        self.cache = cache
+        # Optional StageProfiler recording every step that runs
+        self.profiler = profiler
+        # Whether preprocess() only runs each unique utterance once, and
+        # the counts from its last run
+        self.deduplicate = deduplicate
+        self.dedup_stats = None
+        # Memory ceiling in MB. When set, SpaCy runs in character-sized
+        # batches and no docs are kept (see process_nlp_bounded). Longer
+        # texts than a batch can hold are either 'split' or 'truncate'd.
+        if long_texts not in ('split', 'truncate'):
+            raise ValueError('Unknown long_texts mode: {}'.format(long_texts))
+        self.memory_limit = memory_limit
+        self.long_texts = long_texts
+        self.bounded_stages = ()
+        # Worker processes, started by the first parallel preprocess() and
+        # kept until close() so each worker only loads the models once
+        self.workers = WorkerPool(self.spec)
+
+        # Load SpaCy model and pipeline, shared with other processors
+        # unless share_model is turned off
+        self.share_model = share_model
+        self.nlp = load_nlp(self.pipes, self.spec.model,
+            self.spec.gazetteers, self.spec.gazetteer_cache, shared=share_model)
+        
+    def close(self):
+        """
+        Shuts down the worker processes, if any were started.
+        """
+        self.workers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Load NLP pipeline
+    def load_nlp_pipe(self, pipes):
+        """
+        This function creates and loads all the pipes into the nlp-er.
+        The shared model is left as it is: the processor switches to the
+        shared model for its pipes plus the new ones, loading it if no
+        other processor has. Without share_model, it loads a new model of
+        its own instead, so changes made to the old model in place aren't
+        carried over. Docs parsed by the old model are dropped.
+
+        :pipes: list of pipe names as strings
+        """
+        self.pipes = (self.pipes or []) + list(pipes)
+        self.spec = self.spec.replace(pipes=self.pipes)
+        # Workers were started with the old spec
+        self.workers.close()
+        self.workers = WorkerPool(self.spec)
+        self.drop_docs()
+        self.nlp = load_nlp(self.pipes, self.spec.model,
+            self.spec.gazetteers, self.spec.gazetteer_cache, shared=self.share_model)
+
+    def clean_text(self,
+        drop_excess_whitespace=True,
+        drop_html=True,
+        clean_ascii=True):
+        """
+        Removes excess whitespace, HTML tags, and transliterates
+        non-ASCII characters. 
+        """
+        clean = text_cleaner(drop_excess_whitespace, drop_html, clean_ascii, self.profiler)
+        if clean != None:
+            self.cleaned_utterances = list(map(clean, self.cleaned_utterances))
+        self.flush_profiler()
+
+    def normalise_text(self,
+        fix_spelling=False,
+        normalise_contractions=True,
+        normalise_emojis=True,
+        norm_ents=None,
+        lemma=True,
+        spelling_mode='compound',
+        contraction_slang=True):
+        """
+        Fixes spelling, splits contractions, converts emojis, 
+        normalises entities, and lemmatises.
+        """
+        normalise = text_normaliser(fix_spelling, normalise_contractions, normalise_emojis,
+            spelling_mode, self.profiler, contraction_slang)
+        if normalise != None:
+            self.cleaned_utterances = list(map(normalise, self.cleaned_utterances))
+
+        self.process_nlp(
+            normalise=token_normaliser(norm_ents, lemma),
+            pipes=required_pipes(self.nlp.pipe_names, lemma=lemma, norm_ents=norm_ents))
+        self.flush_profiler()
+
+    def filter_text(self, 
+        drop_stop_words=True,
+        drop_punctuation=True,
+        drop_pos = None,
+        drop_dep = None,
+        drop_ent = None):
+        """
+        Removes punctuation, stopwords, pos, dep, and or entities.
+        """
+        self.process_nlp(
+            keep=token_filter(drop_stop_words, drop_punctuation, drop_pos, drop_dep, drop_ent),
+            pipes=required_pipes(self.nlp.pipe_names,
+                drop_pos=drop_pos, drop_dep=drop_dep, drop_ent=drop_ent))
+        self.flush_profiler()
+
+    def process_nlp(self, keep=None, normalise=None, pipes=None):
+        """
+        Runs SpaCy over the cleaned utterances if that hasn't been done
+        yet, then filters and normalises every utterance's tokens in a
+        single pass.
+
+        Unless disable_unused_pipes was turned off, SpaCy only runs the
+        given pipes and the rest are disabled. If the utterances were
+        already parsed without some of them, those are run over the
+        existing docs. The pipes used are kept in enabled_pipes.
+
+        With keep_docs, the parsed docs are kept as their own stage. Setting
+        nlp_utterances back to None (or calling reset_tokens) starts the
+        token stages again from those docs without reparsing, as long as
+        the cleaned utterances haven't changed. Token stage results are
+        remembered by the configs of the stages that led to them, so
+        re-running the same stages only recomputes the ones that changed.
+        Otherwise the docs are dropped once every token has been turned
+        into a string.
+
+        :keep: predicate from token_filter, or None to keep every token
+        :normalise: function from token_normaliser, or None
+        :pipes: names of the pipes the stages need (see required_pipes),
+        or None for all of them
+        """
+        if pipes == None or not self.disable_unused_pipes:
+            pipes = self.nlp.pipe_names
+        if self.memory_limit != None:
+            self.process_nlp_bounded(keep, normalise, pipes)
+            return
+
+        if self.nlp_utterances == None:
+            source = tuple(self.cleaned_utterances)
+            if self.docs != None and self.docs_source == source:
+                self.complete_docs(pipes)
+            else:
+                self.parse(source, pipes)
+            self.reset_tokens()
+        else:
+            self.complete_docs(pipes)
+
+        if keep == None and normalise == None:
+            return
+        stages = None
+        if self.keep_docs and self.applied_stages != None and all(hasattr(stage, 'config') \
+            for stage in (keep, normalise) if stage != None):
+            stages = self.applied_stages + ((getattr(keep, 'config', None),
+                getattr(normalise, 'config', None)),)
+            if stages in self.stage_results:
+                self.stage_results.move_to_end(stages)
+                self.nlp_utterances = self.stage_results[stages]
+                self.applied_stages = stages
+                return
+
+        if self.profiler != None:
+            # Filtering and normalisation are timed as separate passes
+            if keep != None:
+                self.nlp_utterances = list(map(self.profiler.wrap(
+                    functools.partial(process_tokens, keep=keep), 'filter_tokens', len),
+                    self.nlp_utterances))
+            if normalise != None:
+                self.nlp_utterances = list(map(self.profiler.wrap(
+                    functools.partial(process_tokens, normalise=normalise), 'normalise_tokens', len),
+                    self.nlp_utterances))
+        else:
+            self.nlp_utterances = [process_tokens(utterance, keep, normalise) \
+                for utterance in self.nlp_utterances]
+
+        self.applied_stages = stages
+        if stages != None:
+            self.stage_results[stages] = self.nlp_utterances
+            if len(self.stage_results) > self.max_stage_results:
+                self.stage_results.popitem(last=False)
+        elif not self.keep_docs and all(type(token) == str \
+            for utterance in self.nlp_utterances for token in utterance):
+            self.drop_docs()
+
+    def parse(self, source, pipes):
+        """
+        Parses the cleaned utterances into the doc stage, running only the
+        given pipes.
+
+        :source: tuple of the cleaned utterances.
+        :pipes: names of the pipes to run.
+        """
+        disable = [name for name in self.nlp.pipe_names if name not in pipes]
+        start = time.perf_counter()
+        self.docs = list(self.nlp.pipe(source, disable=disable))
+        if self.profiler != None:
+            self.profiler.add('nlp.pipe', time.perf_counter() - start,
+                sum(map(count_words, source)), sum(map(len, self.docs)),
+                calls=len(self.docs))
+        self.enabled_pipes = list(pipes)
+        self.docs_source = source
+        self.stage_results.clear()
+
+    def process_nlp_bounded(self, keep=None, normalise=None, pipes=None):
+        """
+        Memory-bounded version of process_nlp, used when the processor has
+        a memory_limit. SpaCy runs over batches sized by their total
+        characters, texts too long for a batch are split (or truncated),
+        and each doc is dropped as soon as its tokens have been turned into
+        strings, so nlp_utterances holds lists of strings. The batch size
+        halves whenever the process goes over the limit.
+
+        No docs are kept to reuse, so each call reparses the utterances
+        first parsed (kept in docs_source) and reapplies every stage since
+        nlp_utterances was last reset.
+        """
+        pipes = self.nlp.pipe_names if pipes == None else pipes
+        if self.nlp_utterances == None or self.docs_source == None:
+            self.docs_source = tuple(self.cleaned_utterances)
+            self.bounded_stages = ()
+        elif self.enabled_pipes != None:
+            pipes = [name for name in self.nlp.pipe_names \
+                if name in pipes or name in self.enabled_pipes]
+        if keep != None or normalise != None:
+            self.bounded_stages += ((keep, normalise),)
+
+        self.docs = None
+        self.applied_stages = None
+        self.stage_results.clear()
+        self.enabled_pipes = list(pipes)
+        self.nlp_utterances = list(self.pipe_bounded(self.docs_source, pipes, self.bounded_stages))
+
+    def pipe_bounded(self, utterances, pipes, stages=()):
+        """
+        Lazily parses utterances in batches that fit the memory limit and
+        runs the token stages over each doc before letting it go.
+
+        :utterances: iterable of strings.
+        :pipes: names of the pipes to run.
+        :stages: sequence of (keep, normalise) pairs, applied in order.
+        :return: generator of lists of string tokens, in input order.
+        """
+        disable = [name for name in self.nlp.pipe_names if name not in pipes]
+        # Texts are only cut to fit the whole budget, so they come out the
+        # same however much memory is already in use
+        max_length = min(max(MIN_BATCH_CHARS, int(self.memory_limit * CHARS_PER_MB)),
+            self.nlp.max_length)
+        rss = current_rss_mb()
+        headroom = self.memory_limit - rss if rss != None else self.memory_limit
+        max_chars = max(MIN_BATCH_CHARS, int(headroom * CHARS_PER_MB))
+
+        for batch in char_batches(utterances, max_chars):
+            if self.long_texts == 'truncate':
+                pieces = [[utterance[:max_length]] for utterance in batch]
+            else:
+                pieces = [split_text(utterance, max_length) for utterance in batch]
+            start = time.perf_counter()
+            docs = self.nlp.pipe(concat(pieces), disable=disable, batch_size=sum(map(len, pieces)))
+            tokens_out = 0
+            for utterance_pieces in pieces:
+                tokens = []
+                for doc in itertools.islice(docs, len(utterance_pieces)):
+                    processed = doc
+                    for keep, normalise in stages:
+                        processed = process_tokens(processed, keep, normalise)
+                    tokens.extend(tokens_to_text(processed))
+                    del doc, processed
+                tokens_out += len(tokens)
+                yield tokens
+            if self.profiler != None:
+                self.profiler.add('nlp.pipe_bounded', time.perf_counter() - start,
+                    sum(map(count_words, batch)), tokens_out, calls=len(batch))
+
+            rss = current_rss_mb()
+            if rss != None and rss > self.memory_limit and max_chars > MIN_BATCH_CHARS:
+                max_chars = max(MIN_BATCH_CHARS, max_chars // 2)
+                gc.collect()
+
+    def drop_docs(self):
+        """
+        Lets go of the parsed docs and the token stage results kept from
+        them. The next call to reset_tokens reparses.
+        """
+        self.docs = None
+        self.docs_source = None
+        self.applied_stages = None
+        self.stage_results.clear()
+
+    def reset_tokens(self):
+        """
+        Throws away the token stages and starts again from the parsed docs,
+        without reparsing.
+        """
+        self.nlp_utterances = self.docs
+        self.applied_stages = ()
+
+    def save_docs(self, path):
+        """
+        Saves the parsed docs and the pipes they were run through to disk
+        as a SpaCy DocBin, so they can be reloaded without reparsing.
+        Docs are only kept after parsing in a single process without a
+        memory_limit, and past preprocess() with keep_docs.
+
+        :path: file to write.
+        """
+        if self.docs == None:
+            raise ValueError('There are no parsed docs to save. Run filter_text or normalise_text '
+                'first, in a single process and without a memory_limit, or set keep_docs.')
+        import srsly
+        from spacy.tokens import DocBin
+        doc_bin = DocBin(attrs=['ORTH', 'TAG', 'POS', 'HEAD', 'DEP', 'LEMMA', 'ENT_IOB', 'ENT_TYPE'])
+        for doc in self.docs:
+            doc_bin.add(doc)
+        srsly.write_msgpack(path, {'docs': doc_bin.to_bytes(), 'pipes': self.enabled_pipes})
+
+    def load_docs(self, path):
+        """
+        Loads docs saved with save_docs as the doc stage and starts the
+        token stages again from them.
+
+        :path: file to read.
+        """
+        import srsly
+        from spacy.tokens import DocBin
+        saved = srsly.read_msgpack(path)
+        self.docs = list(DocBin().from_bytes(saved['docs']).get_docs(self.nlp.vocab))
+        self.enabled_pipes = saved['pipes']
+        self.docs_source = tuple(doc.text for doc in self.docs)
+        self.stage_results.clear()
+        self.reset_tokens()
+
+    def flush_profiler(self):
+        """
+        Passes the steps recorded by the profiler, if there is one, to its callbacks.
+        """
+        if self.profiler != None:
+            self.profiler.flush()
+
+    def complete_docs(self, pipes):
+        """
+        Runs any of the given pipes that haven't been run yet over the
+        parsed docs. Annotations are set on the docs in place, so tokens
+        already in nlp_utterances pick them up.
+
+        :pipes: names of the pipes the docs need
+        """
+        if self.docs == None:
+            return
+        missing = [name for name in pipes if name not in self.enabled_pipes]
+        for name in missing:
+            component = self.nlp.get_pipe(name)
+            start = time.perf_counter()
+            # In place, so the list is the same doc stage as before
+            if hasattr(component, 'pipe'):
+                self.docs[:] = component.pipe(self.docs)
+            else:
+                self.docs[:] = map(component, self.docs)
+            if self.profiler != None:
+                tokens = sum(map(len, self.docs))
+                self.profiler.add('nlp.' + name, time.perf_counter() - start, tokens, tokens,
+                    calls=len(self.docs))
+        if missing:
+            self.enabled_pipes = [name for name in self.nlp.pipe_names \
+                if name in self.enabled_pipes or name in missing]
+
+    def preprocess(self, n_process=None, batch_size=1000):
+        """"
+        Cleans, normalises, filters, and finally normalises a set of 
+        utterances. This function takes all the defaults for most 
+        purposes. Strips HTML tags, removes excess whitespace,
+        transliterates non-ASCII characters, converts emojis,
+        expands contractions, fixes spelling, removes stop words,
+        removes punctuation, normalises common entities, and lemmatises
+        words. 
+
+        With more than one process, the utterances are sharded into
+        batches of batch_size across a process pool and the results are
+        lists of strings rather than SpaCy tokens. The same goes when the
+        processor has a cache, in which case only utterances that aren't
+        cached are processed. Either way, cleaned_utterances ends up
+        holding the cleaned and normalised text that SpaCy parsed.
+
+        When the processor deduplicates, utterances that are the same once
+        cleaned, with whitespace collapsed and case folded, are only
+        processed once and every copy gets the first one's result. The
+        counts are kept in dedup_stats.
+
+        :n_process: number of processes to use (-1 for all cores).
+        Defaults to the processor's n_process.
+        :batch_size: number of utterances sent to a worker at a time.
+        """
+        if self.deduplicate:
+            self._preprocess_deduplicated(n_process, batch_size)
+            return
+        self._preprocess_cached(n_process, batch_size)
+
+    def _preprocess_deduplicated(self, n_process=None, batch_size=1000):
+        # Only group utterances the spec's own clean_text would make equal.
+        # Each utterance is cleaned once here, and the unique ones then only
+        # go through the normalisation steps.
+        utterances = self.cleaned_utterances
+        clean = self.spec.text_cleaner(self.profiler)
+        if clean != None:
+            utterances = list(map(clean, utterances))
+        start = time.perf_counter()
+        uniques, positions = deduplicate(utterances, functools.partial(dedup_key, clean=str))
+        if self.profiler != None:
+            self.profiler.add('deduplicate', time.perf_counter() - start,
+                len(utterances), len(uniques), calls=len(utterances))
+        self.dedup_stats = {
+            'utterances': len(utterances),
+            'unique': len(uniques),
+            'dedup_ratio': 1 - len(uniques) / len(utterances) if utterances else 0.0,
+        }
+
+        self.cleaned_utterances = uniques
+        self.nlp_utterances = None
+        self._preprocess_cached(n_process, batch_size, cleaned=True)
+        # Broadcast back to the original positions
+        self.cleaned_utterances = [self.cleaned_utterances[index] for index in positions]
+        self.nlp_utterances = [self.nlp_utterances[index] for index in positions]
+        self.flush_profiler()
+
+    def cache_config(self, cleaned=False):
+        """
+        :cleaned: whether the utterances have already been through the
+        spec's cleaning steps.
+        :return: ResultCache config covering everything that changes what
+        preprocess() returns: the spec, the loaded model and its gazetteer,
+        and the memory settings that decide how long texts are split.
+        """
+        return ('preprocess', self.spec, model_fingerprint(self.nlp),
+            self.memory_limit, self.long_texts, cleaned)
+
+    def _preprocess_cached(self, n_process=None, batch_size=1000, cleaned=False):
+        if self.cache != None:
+            # The cleaned text is cached with the tokens, so hits leave
+            # cleaned_utterances the same as a run without the cache
+            results = self.cache.apply(
+                functools.partial(self._preprocess_uncached, n_process=n_process,
+                    batch_size=batch_size, cleaned=cleaned),
+                self.cleaned_utterances,
+                self.cache_config(cleaned))
+            self.cleaned_utterances = [text for text, _ in results]
+            self.nlp_utterances = [tokens for _, tokens in results]
+            return
+        self._preprocess(n_process, batch_size, cleaned)
+
+    def _preprocess_uncached(self, utterances, n_process=None, batch_size=1000, cleaned=False):
+        self.cleaned_utterances = utterances
+        self.nlp_utterances = None
+        self._preprocess(n_process, batch_size, cleaned)
+        return [[text, tokens_to_text(tokens)] \
+            for text, tokens in zip(self.cleaned_utterances, self.nlp_utterances)]
+
+    def _preprocess(self, n_process=None, batch_size=1000, cleaned=False):
+        n_process = self.n_process if n_process == None else n_process
+        if n_process == -1:
+            n_process = os.cpu_count()
+        if n_process > 1:
+            start = time.perf_counter()
+            # Each worker gets an equal share of the memory ceiling
+            memory_limit = self.memory_limit / n_process if self.memory_limit != None else None
+            words_in = sum(map(count_words, self.cleaned_utterances)) if self.profiler != None else 0
+            results = list(concat(self.workers.map(
+                self.cleaned_utterances, n_process, batch_size, memory_limit, cleaned)))
+            self.cleaned_utterances = [text for text, _ in results]
+            self.nlp_utterances = [tokens for _, tokens in results]
+            if self.profiler != None:
+                self.profiler.add('parallel_preprocess', time.perf_counter() - start,
+                    words_in, sum(map(len, self.nlp_utterances)),
+                    calls=len(self.nlp_utterances))
+                self.profiler.flush()
+            return
+
+        # The same steps as the spec's compiled Pipeline, run through the
+        # doc stage. Steps are only rebuilt to time them with the profiler.
+        pipeline = self.spec.compile()
+        if cleaned:
+            # Only the normalisation steps are left to run
+            clean = pipeline.normalise_text if self.profiler == None \
+                else self.spec.text_normaliser(self.profiler)
+        else:
+            clean = pipeline.clean if self.profiler == None else self.spec.text_function(self.profiler)
+        if clean != None:
+            self.cleaned_utterances = list(map(clean, self.cleaned_utterances))
+        self.process_nlp(
+            keep=pipeline.keep,
+            normalise=pipeline.normalise,
+            pipes=self.spec.required_pipes(self.nlp.pipe_names))
+        if not self.keep_docs:
+            self.drop_docs()
+        self.flush_profiler()
+
+    def to_arrays(self):
+        """
+        Converts the processed utterances to compact TokenArrays, which
+        don't keep the SpaCy docs alive.
+
+        :return: TokenArrays
+        """
+        if self.nlp_utterances == None:
+            raise ValueError('There are no processed utterances to convert. Run preprocess, '
+                'filter_text or normalise_text first.')
+        return TokenArrays.from_utterances(self.nlp_utterances)
+
+    def preprocess_stream(self, utterances, batch_size=1000):
+        """
+        Lazily preprocesses any iterable of utterances (e.g. a file handle
+        or a database cursor) with the same steps as preprocess(), yielding
+        one processed utterance at a time. Utterances are worked through in
+        batches of batch_size, so memory use stays flat however large the
+        corpus is. The processor's utterance lists only ever hold the
+        current batch. With more than one process, every batch goes to the
+        same worker pool, which stays up until close().
+
+        :utterances: any iterable of strings.
+        :batch_size: number of utterances to hold in memory at once.
+        :return: generator of processed utterances, in input order.
+        """
+        for batch in partition_all(batch_size, utterances):
+            self.cleaned_utterances = list(batch)
+            self.nlp_utterances = None
+            self.preprocess()
+            yield from self.nlp_utterances
+
+
+def tokens_to_text(utterance):
+    """
+    Converts a processed utterance to plain strings.
+
+    :utterance: a SpaCy doc object (https://spacy.io/api/doc) or list of tokens
+    and strings
+    :return: list of string tokens.
+    """
+    return [token if isinstance(token, str) else token.text for token in utterance]
+
+_worker_processor = None
+
+def _worker(spec, memory_limit=None, share_model=True):
+    """
+    Loads the SpaCy model and, if the spec fixes spelling, the spelling
+    dictionary.
+
+    :share_model: whether to use the shared model. Processors run in a
+    background thread load their own, since SpaCy models aren't thread-safe.
+    :return: TextPreprocessing for the spec.
+    """
+    if spec.fix_spelling:
+        load_sym_spell_dict()
+    return TextPreprocessing([], spec=spec, memory_limit=memory_limit, share_model=share_model)
+
+def _init_worker(spec, memory_limit=None):
+    """
+    Loads the processor once per worker process.
+    """
+    global _worker_processor
+    _worker_processor = _worker(spec, memory_limit)
+
+# Held while a background thread loads its processor, so preprocessors
+# in thread mode don't load the spelling dictionary at the same time.
+thread_lock = threading.Lock()
+
+def _preprocess_batch(batch, processor=None, cleaned=False):
+    """
+    Preprocesses a batch of utterances inside a worker.
+
+    :batch: sequence of strings.
+    :processor: TextPreprocessing to use. Defaults to the worker process's.
+    :cleaned: whether the utterances have already been through the spec's cleaning steps.
+    :return: list of (cleaned text, processed utterance as a list of strings) pairs.
+    """
+    processor = _worker_processor if processor == None else processor
+    processor.cleaned_utterances = list(batch)
+    processor.nlp_utterances = None
+    processor._preprocess(n_process=1, cleaned=cleaned)
+    return list(zip(processor.cleaned_utterances, map(tokens_to_text, processor.nlp_utterances)))
+
+
+# Worker pools with processes running, shut down at exit if nothing
+# closed them first (e.g. those of pipelines cached by compile())
+running_worker_pools = weakref.WeakSet()
+
+@atexit.register
+def close_worker_pools():
+    """
+    Shuts down every worker pool that is still running.
+    """
+    for workers in list(running_worker_pools):
+        workers.close()
+
+class WorkerPool():
+    """
+    Pool of worker processes for a spec, started on first use and kept,
+    so each worker loads the SpaCy model and spelling dictionary once
+    however many batches are sent to it. It is restarted if a different
+    number of processes or memory ceiling is asked for, and shut down at
+    exit if it wasn't closed.
+    """
+
+    def __init__(self, spec) -> None:
+        self.spec = spec
+        self.pool = None
+        self.settings = None
+
+    def map(self, utterances, n_process, batch_size=1000, memory_limit=None, cleaned=False):
+        """
+        :utterances: sequence of strings.
+        :n_process: number of worker processes.
+        :batch_size: number of utterances sent to a worker at a time.
+        :memory_limit: memory ceiling in MB for each worker, or None.
+        :cleaned: whether the utterances have already been through the spec's cleaning steps.
+        :return: list of batches of (cleaned text, processed utterance as a
+        list of strings) pairs, in input order.
+        """
+        if self.pool != None and self.settings != (n_process, memory_limit):
+            self.close()
+        if self.pool == None:
+            self.pool = multiprocessing.Pool(n_process, _init_worker, (self.spec, memory_limit))
+            self.settings = (n_process, memory_limit)
+            running_worker_pools.add(self)
+        return self.pool.map(functools.partial(_preprocess_batch, cleaned=cleaned),
+            partition_all(batch_size, utterances))
+
+    def close(self):
+        """
+        Shuts the workers down, if they were started.
+        """
+        if self.pool != None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.settings = None
+            running_worker_pools.discard(self)
+
+
+class AsyncPreprocessor():
+    """
+    Asyncio front end for online preprocessing. Single utterances are
+    awaited one at a time, grouped with other concurrent requests into
+    micro-batches and preprocessed off the event loop, either in a
+    background thread or in a pool of worker processes. Each worker loads
+    the SpaCy model and spelling dictionary once.
+
+    Usage:
+        async with AsyncPreprocessor(n_process=4) as preprocessor:
+            tokens = await preprocessor.preprocess('Some text')
+    """
+
+    def __init__(self, pipes=['entity_ruler', 'sentencizer'],
+        max_batch_size=64,
+        max_wait=0.01,
+        max_pending=1024,
+        max_concurrency=None,
+        n_process=None,
+        spec=None) -> None:
+        """
+        :pipes: list of pipe names to load into the nlp-er.
+        :max_batch_size: most utterances sent to a worker at a time.
+        :max_wait: longest time in seconds to wait for a batch to fill.
+        :max_pending: most utterances queued before callers have to wait.
+        :max_concurrency: most batches being processed at once. Defaults to n_process, or 1.
+        :n_process: number of worker processes, or None to use one background thread.
+        :spec: PipelineSpec of the steps to run. Its pipes are used in place of pipes.
+        """
+        self.spec = spec if spec != None else PipelineSpec(pipes=pipes)
+        self.pipes = list(self.spec.pipes) if self.spec.pipes != None else None
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.max_concurrency = max_concurrency if max_concurrency != None else (n_process or 1)
+        self.n_process = n_process
+        self.executor = None
+        # Processor used in thread mode. Worker processes keep their own.
+        self.processor = None
+        self.queue = None
+        self.semaphore = None
+        self.batcher = None
+        self.running = set()
+        # Requests the batcher has taken off the queue but not yet sent
+        self.batch = []
+        self.closing = False
+        self.putting = 0
+
+    async def start(self):
+        """
+        Starts the worker pool and the batching task.
+        """
+        if self.batcher != None:
+            return
+        if self.n_process:
+            self.executor = ProcessPoolExecutor(self.n_process,
+                initializer=_init_worker, initargs=(self.spec,))
+        else:
+            # The processor stays on this instance so other preprocessors
+            # can't replace it. It loads its own model, so batches don't
+            # have to take turns with other threads using the shared ones.
+            self.executor = ThreadPoolExecutor(1, initializer=self._load_processor)
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.batcher = asyncio.ensure_future(self._batch_requests())
+
+    async def close(self):
+        """
+        Stops taking new requests, processes the ones already queued,
+        finishes every batch and shuts the workers down.
+        """
+        if self.batcher == None:
+            return
+        self.closing = True
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        # Send what the batcher had taken and everything still queued,
+        # including requests from callers that were waiting for room
+        pending = self.batch
+        self.batch = []
+        while pending or not self.queue.empty() or self.putting:
+            while not self.queue.empty():
+                pending.append(self.queue.get_nowait())
+            for batch in partition_all(self.max_batch_size, pending):
+                await self._submit(list(batch))
+            pending = []
+            await asyncio.sleep(0)
+        if self.running:
+            await asyncio.wait(self.running)
+        self.executor.shutdown()
+        self.batcher = None
+        self.closing = False
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def preprocess(self, utterance):
+        """
+        Preprocesses a single utterance with the same steps as
+        TextPreprocessing.preprocess(). Waits if too many utterances are
+        already queued.
+
+        :utterance: string to preprocess.
+        :return: the processed utterance as a list of strings.
+        """
+        if not isinstance(utterance, str):
+            raise TypeError('Utterance must be a string, not {}'.format(type(utterance).__name__))
+        if self.closing:
+            raise RuntimeError('AsyncPreprocessor is closing')
+        await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.putting += 1
+        try:
+            await self.queue.put((utterance, future))
+        finally:
+            self.putting -= 1
+        return await future
+
+    async def _batch_requests(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.batch.append(await self.queue.get())
+            deadline = loop.time() + self.max_wait
+            while len(self.batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    self.batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch = self.batch
+            await self._submit(batch)
+            self.batch = []
+
+    def _load_processor(self):
+        with thread_lock:
+            if self.processor == None:
+                self.processor = _worker(self.spec, share_model=False)
+
+    def _preprocess_in_thread(self, batch):
+        return _preprocess_batch(batch, self.processor)
+
+    async def _submit(self, batch):
+        await self.semaphore.acquire()
+        task = asyncio.ensure_future(self._run_batch(batch))
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _run_batch(self, batch):
+        preprocess = _preprocess_batch if self.n_process else self._preprocess_in_thread
+        try:
+            if len(batch) == 1:
+                await self._run_request(preprocess, *batch[0])
+                return
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.executor, preprocess, [utterance for utterance, _ in batch])
+            except Exception:
+                # Retry one at a time, so only the requests that fail get the error
+                for utterance, future in batch:
+                    await self._run_request(preprocess, utterance, future)
+            else:
+                for (_, future), (_, tokens) in zip(batch, results):
+                    if not future.done():
+                        future.set_result(tokens)
+        finally:
+            self.semaphore.release()
+
+    async def _run_request(self, preprocess, utterance, future):
+        try:
+            [(_, tokens)] = await asyncio.get_running_loop().run_in_executor(
+                self.executor, preprocess, [utterance])
+        except Exception as error:
+            if not future.done():
+                future.set_exception(error)
+        else:
+            if not future.done():
+                future.set_result(tokens)
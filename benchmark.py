@@ -0,0 +1,246 @@
+"""
+Benchmarks the cost of each preprocessing step.
+
+Builds synthetic and fixture corpora of set sizes, times each stage
+function over them and reports utterances/sec, p50/p99 latency per
+utterance, the change in RSS over each stage and the process's peak
+RSS, optionally as JSON so runs can be compared between releases.
+Besides the single steps, the fused text function and the bulk token
+stages that preprocess() actually runs are timed too. nlp.pipe parses
+in batches, so its throughput comes from nlp.pipe over the whole corpus
+and its latencies from parsing each utterance on its own with nlp().
+
+Usage:
+    python benchmark.py --sizes 100 1000 --output bench.json
+    python benchmark.py --stages convert_emojis correct_spelling
+"""
+import argparse
+import json
+import random
+import time
+
+import TextPreprocessing as tp
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+WORDS = [
+    'the', 'customer', 'said', 'their', 'order', 'never', 'arrived', 'and',
+    'they', 'want', 'a', 'refund', 'for', 'delivery', 'on', 'friday',
+    'John', 'paid', '$200', 'yesterday', 'please', 'call', 'back', 'about',
+    'account', 'password', 'reset', 'is', 'not', 'working', 'again', 'today',
+]
+MISSPELLINGS = ['recieved', 'acount', 'pasword', 'tommorow', 'definately', 'wierd']
+CONTRACTIONS = ["don't", "I'm", "can't", "we've", "it's", "they're"]
+EMOTICONS = [':)', ':D', ':(', ';)', ':P']
+EMOJIS = ['😂', '👍', '🙏', '😡', '🎉']
+HTML = [('<p>', '</p>'), ('<b>', '</b>'), ('<div class="msg">', '</div>')]
+
+FIXTURE = [
+    'This is a testing sentence.',
+    'This is also a test phrase.',
+    'Some things don\'t match with the others.',
+    'John is a common name.',
+    '<p>Tis iz a testing thingy. I\'m wantin to test. John ows me $200 >.<.   </p>',
+    'Will is my best friend. last friday he came to give me $400!',
+]
+
+def synthetic_corpus(size, seed=0):
+    """
+    Builds a corpus of random ticket-like utterances with misspellings,
+    contractions, emoticons, emojis and HTML mixed in.
+
+    :size: number of utterances.
+    :seed: random seed, so runs are comparable.
+    :return: list of strings.
+    """
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        words = rng.choices(WORDS, k=rng.randint(5, 30))
+        for extras in (MISSPELLINGS, CONTRACTIONS, EMOTICONS, EMOJIS):
+            if rng.random() < 0.3:
+                words.insert(rng.randrange(len(words) + 1), rng.choice(extras))
+        utterance = ' '.join(words) + rng.choice(['.', '!', '?', '  '])
+        if rng.random() < 0.3:
+            start, end = rng.choice(HTML)
+            utterance = start + utterance + end
+        corpus.append(utterance)
+    return corpus
+
+def fixture_corpus(size):
+    """
+    Repeats the fixture sentences up to the given size.
+
+    :size: number of utterances.
+    :return: list of strings.
+    """
+    return [FIXTURE[i % len(FIXTURE)] for i in range(size)]
+
+# Utterances each stage is run over untimed first, so one-off costs like
+# compiling regexes on first use aren't counted as latency
+WARMUP = 5
+
+def peak_rss_mb():
+    """
+    :return: the process's peak resident set size in MB so far, or None
+    if unknown. It only ever goes up, so it says nothing about a single stage.
+    """
+    if resource == None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def time_each(function, utterances):
+    """
+    Times a single-utterance function on every utterance, after warming
+    it up on the first few.
+
+    :return: list of per-utterance latencies in seconds.
+    """
+    for utterance in utterances[:WARMUP]:
+        function(utterance)
+    latencies = []
+    for utterance in utterances:
+        start = time.perf_counter()
+        function(utterance)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def time_pipe(nlp, utterances):
+    """
+    Times nlp.pipe over the whole corpus, after warming it up on the
+    first few. Docs come out of nlp.pipe a batch at a time, so the time
+    between them isn't any one utterance's latency: this only gives the
+    throughput.
+
+    :return: total time in seconds.
+    """
+    list(nlp.pipe(utterances[:WARMUP]))
+    start = time.perf_counter()
+    for _ in nlp.pipe(utterances):
+        pass
+    return time.perf_counter() - start
+
+def string_stages():
+    """
+    :return: dictionary of stage name to single-utterance string function.
+    text_function is every step preprocess() runs before SpaCy, fused.
+    """
+    return {
+        'text_function': tp.PipelineSpec().text_function(),
+        'remove_html_tags': tp.remove_html_tags,
+        'remove_excess_whitespace': tp.remove_excess_whitespace,
+        'convert_non_ascii': tp.convert_non_ascii,
+        'convert_emoticons': tp.convert_emoticons,
+        'convert_emojis': tp.convert_emojis,
+        'split_contractions': tp.split_contractions,
+        'correct_spelling': tp.correct_spelling,
+        'correct_spelling_tokens': tp.correct_spelling_tokens,
+    }
+
+def token_stages():
+    """
+    :return: dictionary of stage name to single-doc token function.
+    filter_mask and process_doc are the bulk filter and the combined
+    filter and normalisation preprocess() runs on each doc.
+    """
+    keep, normalise = tp.PipelineSpec().token_stages()
+    return {
+        'filter_mask': keep.mask,
+        'process_doc': lambda doc: tp.process_doc(doc, keep, normalise),
+        'remove_stop_words': tp.remove_stop_words,
+        'remove_punctuation': tp.remove_punctuation,
+        'remove_pos': lambda doc: tp.remove_pos(doc, ['NOUN']),
+        'remove_dependency': lambda doc: tp.remove_dependency(doc, ['nsubj']),
+        'remove_entity': lambda doc: tp.remove_entity(doc, ['PERSON']),
+        'norm_entity': lambda doc: tp.norm_entity(doc, ['PERSON', 'CARDINAL']),
+        'lemmatise': tp.lemmatise,
+    }
+
+STAGES = list(string_stages()) + ['nlp.pipe'] + list(token_stages())
+
+def summarise(stage, corpus_name, latencies, rss_change_mb=None, seconds=None):
+    """
+    :latencies: per-utterance latencies in seconds.
+    :seconds: total time to take the throughput from, if not the sum of the latencies.
+    :return: result dictionary.
+    """
+    total = sum(latencies) if seconds == None else seconds
+    return {
+        'stage': stage,
+        'corpus': corpus_name,
+        'utterances': len(latencies),
+        'utterances_per_sec': len(latencies) / total if total else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'rss_change_mb': rss_change_mb,
+        'process_peak_rss_mb': peak_rss_mb(),
+    }
+
+def run(sizes, stages, corpora=('synthetic', 'fixture')):
+    """
+    Runs the chosen stages over each corpus and size.
+
+    :sizes: list of corpus sizes.
+    :stages: list of stage names (see STAGES).
+    :corpora: which corpora to build.
+    :return: list of result dictionaries, one per stage, corpus and size.
+    """
+    builders = {'synthetic': synthetic_corpus, 'fixture': fixture_corpus}
+    strings = string_stages()
+    tokens = token_stages()
+    needs_nlp = any(stage not in strings for stage in stages)
+    if any(stage.startswith('correct_spelling') for stage in stages):
+        tp.load_sym_spell_dict()
+    nlp = tp.load_nlp(['entity_ruler', 'sentencizer']) if needs_nlp else None
+
+    results = []
+    for corpus_name in corpora:
+        for size in sizes:
+            utterances = builders[corpus_name](size)
+            # Token stages run on docs parsed (untimed) from the cleaned corpus
+            docs = list(nlp.pipe(map(tp.text_cleaner(), utterances))) \
+                if any(stage in tokens for stage in stages) else None
+            for stage in stages:
+                rss = tp.current_rss_mb()
+                seconds = None
+                if stage in strings:
+                    latencies = time_each(strings[stage], utterances)
+                elif stage == 'nlp.pipe':
+                    latencies = time_each(nlp, utterances)
+                    seconds = time_pipe(nlp, utterances)
+                else:
+                    latencies = time_each(tokens[stage], docs)
+                rss_change = round(tp.current_rss_mb() - rss, 2) if rss != None else None
+                results.append(dict(summarise(stage, corpus_name, latencies, rss_change, seconds),
+                    size=size))
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark each text preprocessing stage.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000],
+        help='corpus sizes to run')
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES,
+        help='stages to time (default: all)')
+    parser.add_argument('--corpora', nargs='+', default=['synthetic', 'fixture'],
+        choices=['synthetic', 'fixture'], help='corpora to build')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.stages, args.corpora)
+    for result in results:
+        print('{stage:<26} {corpus:<10} {size:>7} {utterances_per_sec:>12.1f}/s '
+            'p50 {p50_ms:8.3f}ms p99 {p99_ms:8.3f}ms rss change {rss_change_mb}MB '
+            'process peak {process_peak_rss_mb}MB'.format(**result))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Preprocesses large files in chunks.
+
+Reads JSONL, CSV, plain text (one utterance per line) or Parquet (when
+pyarrow is installed) a chunk at a time, runs preprocess() over each
+chunk and writes the results with one buffered write per chunk, so
+multi-GB exports never have to fit in memory. After every chunk the
+number of utterances done is checkpointed next to the output, and
+--resume carries on from the last finished chunk, seeking straight to
+it in JSONL, CSV and text files. Resuming is refused if the input file,
+the I/O settings or the pipeline have changed since the checkpoint.
+
+Usage:
+    python preprocess_file.py tickets.jsonl tickets.out.jsonl --column body
+    python preprocess_file.py export.parquet out.csv --chunk-size 50000 --n-process -1 --resume
+"""
+import argparse
+import csv
+import io
+import itertools
+import json
+import os
+
+from toolz import partition_all
+
+import TextPreprocessing as tp
+
+FORMATS = {
+    '.jsonl': 'jsonl',
+    '.json': 'jsonl',
+    '.csv': 'csv',
+    '.txt': 'text',
+    '.parquet': 'parquet',
+}
+
+def file_format(path, fmt=None):
+    """
+    :return: the format given, or the one matching the file's extension.
+    """
+    if fmt != None:
+        return fmt
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FORMATS:
+        raise ValueError('Unknown file format for {}, pass the format explicitly.'.format(path))
+    return FORMATS[extension]
+
+def decoded_lines(input_file, position):
+    """
+    Reads lines from a binary file as strings.
+
+    :input_file: file opened in binary mode.
+    :position: one-item list kept at the byte offset just past the last line read.
+    :return: generator of strings.
+    """
+    for line in input_file:
+        position[0] += len(line)
+        yield line.decode('utf-8')
+
+def read_records(path, fmt, column='text', offset=0):
+    """
+    Lazily reads records from a file, along with where each one ends, so
+    a later run can start again just past it.
+
+    :path: file to read.
+    :fmt: 'jsonl', 'csv', 'text' or 'parquet'.
+    :column: field holding the utterance (for text files, records get it as their only field).
+    :offset: byte offset to start from, as given with an earlier record.
+    Parquet files can't be read from an offset, so always start at the top.
+    :return: generator of (dictionary, byte offset just past it) pairs. The
+    offsets of Parquet records are None.
+    """
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Reading Parquet files needs pyarrow: pip install pyarrow')
+        for batch in pq.ParquetFile(path).iter_batches():
+            for record in batch.to_pylist():
+                yield record, None
+        return
+    if fmt not in ('jsonl', 'csv', 'text'):
+        raise ValueError('Unknown input format: {}'.format(fmt))
+    with open(path, 'rb') as input_file:
+        position = [0]
+        lines = decoded_lines(input_file, position)
+        if fmt == 'csv':
+            # The header is always read from the top
+            fields = next(csv.reader(lines), None)
+            if fields == None:
+                return
+        if offset:
+            input_file.seek(offset)
+            position[0] = offset
+        if fmt == 'jsonl':
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line), position[0]
+        elif fmt == 'csv':
+            for record in csv.DictReader(lines, fields):
+                yield record, position[0]
+        else:
+            for line in lines:
+                yield {column: line.rstrip('\r\n')}, position[0]
+
+def record_utterance(record, column='text'):
+    """
+    :return: the utterance in the record's column, as a string.
+    """
+    if column not in record:
+        raise ValueError('Record has no {!r} field, pass the field holding the utterance '
+            'as column (--column). Its fields are: {}'.format(column, ', '.join(map(str, record))))
+    return str(record[column] or '')
+
+def csv_fields(records, column='text'):
+    """
+    :records: list of input records, which may not all have the same fields.
+    :return: every field in the records, in order of first appearance, then tokens.
+    """
+    fields = {}
+    for record in records:
+        fields.update(dict.fromkeys(record))
+    fields.pop('tokens', None)
+    return (list(fields) or [column]) + ['tokens']
+
+def format_chunk(records, results, fmt, column='text', header=False, fields=None):
+    """
+    Renders a chunk of records and their results as one string.
+
+    :records: list of input records.
+    :results: list of processed utterances as lists of strings.
+    :fmt: 'jsonl', 'csv' or 'text'.
+    :header: whether to start a CSV with its header row.
+    :fields: the CSV's fields. Defaults to those of the chunk (see csv_fields).
+    Records missing some of them get empty values.
+    :return: string ready to be written in one go.
+    """
+    if fmt == 'text':
+        return ''.join(' '.join(tokens) + '\n' for tokens in results)
+    if fmt == 'jsonl':
+        return ''.join(json.dumps(dict(record, tokens=tokens)) + '\n' \
+            for record, tokens in zip(records, results))
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        fields = csv_fields(records, column) if fields == None else fields
+        extra = set(itertools.chain.from_iterable(records)) - set(fields)
+        if extra:
+            raise ValueError('Records have fields {} that are not in the CSV header {}, '
+                'write JSONL to keep them.'.format(sorted(map(str, extra)), fields))
+        writer = csv.DictWriter(buffer, fields)
+        if header:
+            writer.writeheader()
+        for record, tokens in zip(records, results):
+            writer.writerow(dict(record, tokens=' '.join(tokens)))
+        return buffer.getvalue()
+    raise ValueError('Unknown output format: {}'.format(fmt))
+
+def read_checkpoint(path):
+    """
+    :return: the saved checkpoint, or None if there isn't one.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def run_settings(input_path, column, input_format, output_format, chunk_size, processor):
+    """
+    :processor: the TextPreprocessing the run uses.
+    :return: everything about a run that has to stay the same to resume it:
+    the input file, its size and modification time, the I/O settings and
+    the processor's pipeline spec and settings that change its results.
+    """
+    stat = os.stat(input_path)
+    return {
+        'input': os.path.abspath(input_path),
+        'input_size': stat.st_size,
+        'input_mtime': stat.st_mtime,
+        'column': column,
+        'input_format': input_format,
+        'output_format': output_format,
+        'chunk_size': chunk_size,
+        'spec': repr(processor.spec),
+        'memory_limit': processor.memory_limit,
+        'long_texts': processor.long_texts,
+        'deduplicate': processor.deduplicate,
+    }
+
+def write_checkpoint(path, utterances_done, output_size, settings, fields=None, input_offset=None):
+    """
+    Atomically records how far through the input the run has got.
+
+    :settings: the run's settings, from run_settings.
+    :fields: the CSV output's fields, if writing CSV.
+    :input_offset: byte offset in the input just past the last record
+    done, or None for Parquet input.
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as checkpoint_file:
+        json.dump({'utterances_done': utterances_done, 'output_size': output_size,
+            'settings': settings, 'fields': fields, 'input_offset': input_offset}, checkpoint_file)
+    os.replace(temporary, path)
+
+def preprocess_file(input_path, output_path,
+    column='text',
+    input_format=None,
+    output_format=None,
+    chunk_size=10000,
+    resume=False,
+    processor=None):
+    """
+    Preprocesses a file chunk by chunk, checkpointing after each chunk.
+
+    :input_path: file to read.
+    :output_path: file to write.
+    :column: field holding the utterance.
+    :input_format: 'jsonl', 'csv', 'text' or 'parquet'. Defaults to the extension's.
+    :output_format: 'jsonl', 'csv' or 'text'. Defaults to the extension's.
+    :chunk_size: number of utterances processed and written at a time.
+    :resume: carry on from the last finished chunk of an earlier run with
+    the same input file and settings. Raises ValueError if they differ or
+    the output has been cut short since.
+    :processor: TextPreprocessing to run, e.g. with n_process or a cache set.
+    Its worker pool, if it uses one, is kept for every chunk and left open.
+    :return: number of utterances processed in total.
+    """
+    input_format = file_format(input_path, input_format)
+    output_format = file_format(output_path, output_format)
+    if processor == None:
+        with tp.TextPreprocessing([]) as processor:
+            return preprocess_file(input_path, output_path, column, input_format,
+                output_format, chunk_size, resume, processor)
+    checkpoint_path = output_path + '.checkpoint'
+    settings = run_settings(input_path, column, input_format, output_format, chunk_size, processor)
+
+    checkpoint = read_checkpoint(checkpoint_path) if resume else None
+    done = 0
+    fields = None
+    input_offset = 0
+    if checkpoint != None:
+        if checkpoint.get('settings') != settings:
+            raise ValueError('{} is from a run with a different input file, settings or '
+                'pipeline, start over without resuming.'.format(checkpoint_path))
+        output_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        if output_size < checkpoint['output_size']:
+            raise ValueError('{} is shorter than when {} was written, start over without '
+                'resuming.'.format(output_path, checkpoint_path))
+        done = checkpoint['utterances_done']
+        fields = checkpoint['fields']
+        input_offset = checkpoint['input_offset']
+        # Drop anything written after the last finished chunk
+        with open(output_path, 'ab') as output_file:
+            output_file.truncate(checkpoint['output_size'])
+    elif os.path.exists(checkpoint_path):
+        # The output is about to be started again, so the old checkpoint
+        # no longer describes it
+        os.remove(checkpoint_path)
+
+    records = read_records(input_path, input_format, column, input_offset or 0)
+    if input_offset == None:
+        # Without an offset to seek to, skip the records already done
+        records = itertools.islice(records, done, None)
+    with open(output_path, 'a' if checkpoint != None else 'w', encoding='utf-8', newline='') as output_file:
+        for chunk in partition_all(chunk_size, records):
+            input_offset = chunk[-1][1]
+            chunk = [record for record, _ in chunk]
+            processor.cleaned_utterances = [record_utterance(record, column) for record in chunk]
+            processor.nlp_utterances = None
+            processor.preprocess()
+            results = list(map(tp.tokens_to_text, processor.nlp_utterances))
+            if output_format == 'csv' and fields == None:
+                # The header is written once, so later chunks keep the first one's fields
+                fields = csv_fields(chunk, column)
+            output_file.write(format_chunk(chunk, results, output_format, column,
+                header=done == 0, fields=fields))
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            done += len(chunk)
+            write_checkpoint(checkpoint_path, done, os.fstat(output_file.fileno()).st_size,
+                settings, fields, input_offset)
+    return done
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Preprocess a large file in chunks.')
+    parser.add_argument('input', help='JSONL, CSV, text or Parquet file to read')
+    parser.add_argument('output', help='JSONL, CSV or text file to write')
+    parser.add_argument('--column', default='text', help='field holding the utterance')
+    parser.add_argument('--input-format', choices=['jsonl', 'csv', 'text', 'parquet'])
+    parser.add_argument('--output-format', choices=['jsonl', 'csv', 'text'])
+    parser.add_argument('--chunk-size', type=int, default=10000,
+        help='utterances processed and written at a time')
+    parser.add_argument('--n-process', type=int, default=1,
+        help='worker processes to use (-1 for all cores)')
+    parser.add_argument('--cache', help='sqlite file to cache results in')
+    parser.add_argument('--resume', action='store_true',
+        help='carry on from the last finished chunk of an earlier run')
+    parser.add_argument('--deduplicate', action='store_true',
+        help='process repeated utterances in a chunk only once')
+    parser.add_argument('--memory-limit', type=float,
+        help='memory ceiling in MB for parsing with SpaCy')
+    parser.add_argument('--spec', help='YAML pipeline spec of the steps to run')
+    args = parser.parse_args(argv)
+
+    cache = tp.ResultCache(path=args.cache) if args.cache else None
+    spec = tp.PipelineSpec.from_yaml(args.spec) if args.spec else None
+    processor = tp.TextPreprocessing([], n_process=args.n_process, cache=cache,
+        deduplicate=args.deduplicate, memory_limit=args.memory_limit, spec=spec)
+    with processor:
+        done = preprocess_file(args.input, args.output, args.column, args.input_format,
+            args.output_format, args.chunk_size, args.resume, processor)
+    if cache != None:
+        cache.close()
+    print('Preprocessed {} utterances into {}'.format(done, args.output))
+
+if __name__ == '__main__':
+    main()
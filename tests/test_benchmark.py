@@ -0,0 +1,20 @@
+import unittest
+import benchmark
+
+class test_benchmark(unittest.TestCase):
+
+    def test_run(self):
+        """Tests a small run reports every field for each stage."""
+        results = benchmark.run([5], ['remove_html_tags', 'nlp.pipe', 'filter_mask'], ['fixture'])
+        self.assertEqual([result['stage'] for result in results], \
+            ['remove_html_tags', 'nlp.pipe', 'filter_mask'])
+        for result in results:
+            self.assertEqual(set(result), {'stage', 'corpus', 'size', 'utterances',
+                'utterances_per_sec', 'p50_ms', 'p99_ms', 'rss_change_mb', 'process_peak_rss_mb'})
+            self.assertEqual(result['utterances'], 5)
+            self.assertEqual(result['corpus'], 'fixture')
+            self.assertGreater(result['utterances_per_sec'], 0)
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+
+if __name__ == '__main__':
+    unittest.main()
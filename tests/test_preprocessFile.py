@@ -0,0 +1,100 @@
+import json
+import os
+import tempfile
+import unittest
+import preprocess_file as pf
+import TextPreprocessing as tp
+
+class test_preprocessFile(unittest.TestCase):
+
+    def setUp(self):
+        """Writes a small text file to preprocess."""
+        self.directory = tempfile.TemporaryDirectory()
+        self.input_path = os.path.join(self.directory.name, 'input.txt')
+        self.output_path = os.path.join(self.directory.name, 'output.jsonl')
+        with open(self.input_path, 'w') as input_file:
+            input_file.write('This is a testing sentence.\n' \
+                'Will is my best friend. last friday he came to give me $400!\n' \
+                'John is a common name.\n')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def read_output(self):
+        with open(self.output_path) as output_file:
+            return [json.loads(line) for line in output_file]
+
+    def test_preprocess_file(self):
+        """Tests preprocessing a text file in chunks into JSONL."""
+        done = pf.preprocess_file(self.input_path, self.output_path, chunk_size=2)
+        self.assertEqual(done, 3)
+        records = self.read_output()
+        self.assertEqual(records[1], {
+            'text': 'Will is my best friend. last friday he came to give me $400!',
+            'tokens': ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+        })
+
+    def test_resume(self):
+        """Tests resuming from the last finished chunk after a partial write."""
+        pf.preprocess_file(self.input_path, self.output_path, chunk_size=2)
+        expected = self.read_output()
+        with open(self.output_path, 'rb') as output_file:
+            first_chunk = b''.join(output_file.readlines()[:2])
+        with open(self.input_path, 'rb') as input_file:
+            input_offset = len(b''.join(input_file.readlines()[:2]))
+        checkpoint_path = self.output_path + '.checkpoint'
+        pf.write_checkpoint(checkpoint_path, 2, len(first_chunk),
+            pf.read_checkpoint(checkpoint_path)['settings'], input_offset=input_offset)
+        with open(self.output_path, 'wb') as output_file:
+            output_file.write(first_chunk + b'{"half a rec')
+        done = pf.preprocess_file(self.input_path, self.output_path, chunk_size=2, resume=True)
+        self.assertEqual(done, 3)
+        self.assertEqual(self.read_output(), expected)
+
+    def test_resume_mismatch(self):
+        """Tests resuming is refused for a different input or an output cut short."""
+        pf.preprocess_file(self.input_path, self.output_path, chunk_size=2)
+        other_path = os.path.join(self.directory.name, 'other.txt')
+        with open(other_path, 'w') as other_file:
+            other_file.write('Some other sentence.\n')
+        with self.assertRaises(ValueError):
+            pf.preprocess_file(other_path, self.output_path, chunk_size=2, resume=True)
+        with self.assertRaises(ValueError):
+            pf.preprocess_file(self.input_path, self.output_path, chunk_size=3, resume=True)
+        with tp.TextPreprocessing([], deduplicate=True) as processor, self.assertRaises(ValueError):
+            pf.preprocess_file(self.input_path, self.output_path, chunk_size=2, resume=True,
+                processor=processor)
+        open(self.output_path, 'w').close()
+        with self.assertRaises(ValueError):
+            pf.preprocess_file(self.input_path, self.output_path, chunk_size=2, resume=True)
+
+    def test_fresh_run_drops_checkpoint(self):
+        """Tests a run without resume removes the old checkpoint before writing."""
+        input_path = os.path.join(self.directory.name, 'input.jsonl')
+        with open(input_path, 'w') as input_file:
+            input_file.write('{"text": "This is a testing sentence."}\n')
+        pf.preprocess_file(input_path, self.output_path)
+        # A missing column fails the fresh run after the output is started again
+        with self.assertRaises(ValueError):
+            pf.preprocess_file(input_path, self.output_path, column='body')
+        self.assertFalse(os.path.exists(self.output_path + '.checkpoint'))
+
+    def test_read_records_offset(self):
+        """Tests reading a CSV from the offset given with an earlier record."""
+        input_path = os.path.join(self.directory.name, 'input.csv')
+        with open(input_path, 'w', newline='') as input_file:
+            input_file.write('id,text\r\n1,"two\r\nlines"\r\n2,café\r\n3,last\r\n')
+        records = list(pf.read_records(input_path, 'csv'))
+        self.assertEqual([record for record, _ in records], [{'id': '1', 'text': 'two\r\nlines'},
+            {'id': '2', 'text': 'café'}, {'id': '3', 'text': 'last'}])
+        self.assertEqual(list(pf.read_records(input_path, 'csv', offset=records[0][1])), records[1:])
+
+    def test_format_chunk_csv(self):
+        """Tests rendering a chunk as CSV with a header."""
+        self.assertEqual(pf.format_chunk([{'id': '1', 'text': 'Hi there'}], [['hi']], 'csv', \
+            header=True), 'id,text,tokens\r\n1,Hi there,hi\r\n')
+        self.assertEqual(pf.format_chunk([{'text': 'Hi'}, {'id': '2', 'text': 'Bye'}], [['hi'], ['bye']], \
+            'csv', header=True), 'text,id,tokens\r\nHi,,hi\r\nBye,2,bye\r\n')
+
+if __name__ == '__main__':
+    unittest.main()
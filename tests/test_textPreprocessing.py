@@ -1,3 +1,6 @@
+import asyncio
+import os
+import tempfile
 import unittest
 import TextPreprocessing as tp
 from TextPreprocessing import remove_html_tags
@@ -28,6 +31,48 @@ class test_textPreprocessing(unittest.TestCase):
         self.assertEqual(preprocessor.nlp.pipe_names, \
              ['tagger', 'parser', 'ner'])
 
+    def test_shared_model(self):
+        """Tests that processors with the same pipes share one SpaCy model unless told not to."""
+        preprocessor = tp.TextPreprocessing(self.test_utterances)
+        self.assertIs(preprocessor.nlp, self.preprocessor.nlp)
+        private = tp.TextPreprocessing(self.test_utterances, share_model=False)
+        self.assertIsNot(private.nlp, self.preprocessor.nlp)
+        private.nlp.get_pipe('entity_ruler').add_patterns([{'label': 'ORG', 'pattern': 'Acme'}])
+        self.assertEqual(self.preprocessor.nlp.get_pipe('entity_ruler').patterns, [])
+
+    def test_load_nlp_pipe(self):
+        """Tests adding pipes to one processor leaves the shared model alone."""
+        processor = tp.TextPreprocessing(self.test_utterances, pipes=['entity_ruler'])
+        other = tp.TextPreprocessing(self.test_utterances, pipes=['entity_ruler'])
+        processor.load_nlp_pipe(['sentencizer'])
+        self.assertIn('sentencizer', processor.nlp.pipe_names)
+        self.assertNotIn('sentencizer', other.nlp.pipe_names)
+        self.assertEqual(processor.spec.pipes, ('entity_ruler', 'sentencizer'))
+
+    def test_required_pipes(self):
+        """Tests working out which SpaCy components the stages need."""
+        pipe_names = ['tagger', 'sentencizer', 'parser', 'ner', 'entity_ruler', 'custom']
+        self.assertEqual(tp.required_pipes(pipe_names), ['custom'])
+        self.assertEqual(tp.required_pipes(pipe_names, drop_dep=['nsubj']), \
+            ['sentencizer', 'parser', 'custom'])
+        self.assertEqual(tp.required_pipes(pipe_names, lemma=True, norm_ents=['PERSON']), \
+            ['tagger', 'ner', 'entity_ruler', 'custom'])
+
+    def test_disable_unused_pipes(self):
+        """Tests that only the needed components run, and missing ones are added later."""
+        processor = tp.TextPreprocessing(self.test_utterances)
+        processor.filter_text(
+            drop_stop_words=True,
+            drop_punctuation=True)
+        self.assertEqual(processor.enabled_pipes, [])
+        processor.normalise_text(
+            normalise_contractions=False,
+            normalise_emojis=False,
+            norm_ents=['PERSON'],
+            lemma=False)
+        self.assertEqual(processor.enabled_pipes, ['ner', 'entity_ruler'])
+        self.assertEqual(processor.nlp_utterances[3][0], 'PERSON')
+
     def test_tokenizer(self):
         """Tests to see if the preprocessor has tokenised correctly"""
         self.preprocessor.nlp_utterances = None
@@ -37,6 +82,48 @@ class test_textPreprocessing(unittest.TestCase):
         self.assertEqual(['This', 'is', 'a', 'testing', 'sentence'], \
             [token.text for token in self.preprocessor.nlp_utterances[0]])
 
+    def test_reuse_docs(self):
+        """Tests that new filter options are applied to the parsed docs without reparsing."""
+        processor = tp.TextPreprocessing(self.test_utterances, keep_docs=True)
+        processor.filter_text(drop_stop_words=True, drop_punctuation=True)
+        docs = processor.docs
+        parsed = list(docs)
+        processor.nlp_utterances = None
+        processor.filter_text(drop_stop_words=False, drop_punctuation=False, drop_pos=['NOUN'])
+        self.assertIs(processor.docs, docs)
+        self.assertTrue(all(doc is parsed_doc for doc, parsed_doc in zip(docs, parsed)))
+        self.assertEqual([token.text for token in processor.nlp_utterances[3]], \
+            ['John', 'is', 'a', 'common', '.'])
+        filtered = processor.nlp_utterances
+        processor.reset_tokens()
+        processor.filter_text(drop_stop_words=False, drop_punctuation=False, drop_pos=['NOUN'])
+        self.assertIs(processor.nlp_utterances, filtered)
+
+    def test_save_docs(self):
+        """Tests saving the parsed docs and loading them into another processor."""
+        processor = tp.TextPreprocessing(self.test_utterances)
+        processor.filter_text(drop_stop_words=False, drop_punctuation=False, drop_ent=['PERSON'])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'docs.msgpack')
+            processor.save_docs(path)
+            loaded = tp.TextPreprocessing(self.test_utterances)
+            loaded.load_docs(path)
+        loaded.filter_text(drop_stop_words=False, drop_punctuation=False, drop_ent=['PERSON'])
+        self.assertEqual([token.text for token in loaded.nlp_utterances[3]], \
+            ['is', 'a', 'common', 'name', '.'])
+        with self.assertRaises(ValueError):
+            tp.TextPreprocessing(self.test_utterances).save_docs(path)
+
+    def test_keep_docs(self):
+        """Tests docs are only kept past preprocess() when asked for."""
+        processor = tp.TextPreprocessing(self.test_utterances)
+        processor.preprocess()
+        self.assertEqual(processor.docs, None)
+        self.assertEqual(len(processor.stage_results), 0)
+        processor = tp.TextPreprocessing(self.test_utterances, keep_docs=True)
+        processor.preprocess()
+        self.assertEqual(len(processor.docs), len(self.test_utterances))
+
     def test_remove_stop_words(self):
         """Checks that stop words are being removed correctly."""
         self.preprocessor.nlp_utterances = None
@@ -99,6 +186,22 @@ class test_textPreprocessing(unittest.TestCase):
         text_no_pos = [token.text for token in no_pos]
         self.assertEqual(text_no_pos, ['John', 'is', 'a', 'common', '.'])
 
+    def test_process_doc(self):
+        """Tests that bulk doc filtering matches filtering token by token."""
+        keep = tp.token_filter(drop_pos=['NOUN'], drop_dep=['nsubj'], drop_ent=['DATE'])
+        normalise = tp.token_normaliser(norm_ents=['PERSON'], lemma=True)
+        for doc in self.preprocessor.nlp.pipe(self.test_utterances + ['John came last friday.']):
+            self.assertEqual(tp.tokens_to_text(tp.process_doc(doc, keep, normalise)), \
+                tp.tokens_to_text(tp.process_tokens(list(doc), keep, normalise)))
+            self.assertEqual(tp.tokens_to_text(tp.process_doc(doc, keep)), \
+                tp.tokens_to_text(tp.process_tokens(list(doc), keep)))
+        # Without a tagger, lemmas come from the lookup tables
+        lemma = tp.token_normaliser(lemma=True)
+        for doc in self.preprocessor.nlp.pipe(self.test_utterances, disable=['tagger']):
+            self.assertEqual(tp.tokens_to_text(tp.process_doc(doc, None, lemma)), \
+                tp.tokens_to_text(tp.process_tokens(list(doc), None, lemma)))
+            self.assertNotIn('', tp.process_doc(doc, None, lemma))
+
     def test_correct_spelling(self):
         """Testing the spell checker."""
         tp.load_sym_spell_dict()
@@ -128,11 +231,79 @@ class test_textPreprocessing(unittest.TestCase):
         self.assertEqual(tp.correct_spelling('I\'ve never been to the US though I\'m keen.'), \
             'Have never been to the US though I\'m keen')
 
+    def test_correct_spelling_tokens(self):
+        """Tests correcting only the unknown words of a string."""
+        tp.load_sym_spell_dict()
+        self.assertEqual(tp.correct_spelling_tokens('Thsi is a test.'), 'This is a test.')
+
+    def test_correct_spelling_tokens_unicode(self):
+        """Tests non-ASCII words are corrected whole and known contractions left alone."""
+        tp.load_sym_spell_dict()
+        self.assertEqual(tp.correct_spelling_tokens('Café naïve'), tp.correct_spelling('Café naïve'))
+        self.assertEqual(tp.correct_spelling_tokens('Café naïve'), 'Cafe naive')
+        self.assertEqual(tp.correct_spelling_tokens('They\'ve gone, but we\'d stay.'), \
+            'They\'ve gone, but we\'d stay.')
+
+    def test_correct_spelling_tokens_acronyms(self):
+        """Tests acronyms are left alone, as lookup_compound does, and every word is counted."""
+        tp.load_sym_spell_dict()
+        text = 'AWS and SQL over a VPN at NASA in the USA'
+        self.assertEqual(tp.correct_spelling_tokens(text), text)
+        self.assertEqual(tp.correct_spelling(text), text)
+        before = tp.spelling_cache_info()
+        tp.correct_spelling_tokens('Thsi and thsi')
+        after = tp.spelling_cache_info()
+        self.assertEqual(after['in_vocabulary'] - before['in_vocabulary'], 1)
+        self.assertEqual(after['lookup'] - before['lookup'], 2)
+
+    def test_correct_spelling_tokens_joined(self):
+        """Tests the compound fallback for joined words."""
+        tp.load_sym_spell_dict()
+        self.assertEqual(tp.correct_spelling_tokens('somethingCaroline did.'), \
+            'something Caroline did.')
+        self.assertEqual(tp.correct_spelling_tokens('somethingCaroline did.', \
+            compound_fallback=False), 'somethingCaroline did.')
+
+    def test_sym_spell_snapshot(self):
+        """Tests saving a snapshot of the spelling dictionary."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sym_spell.pickle')
+            tp.load_sym_spell_dict(snapshot_path=path)
+            self.assertTrue(os.path.exists(path))
+            self.assertIs(tp.load_sym_spell_dict(snapshot_path=path), tp.sym_spell)
+
     def test_remove_html_tags(self):
         """Test removing HTML tags from a string."""
         self.assertEqual(tp.remove_html_tags('<title>Testing string</title>'), \
             'Testing string')
 
+    def test_remove_html_script_and_entities(self):
+        """Test dropping script bodies and comments and decoding entities."""
+        self.assertEqual(tp.remove_html_tags( \
+            '<script>var a = "<b>";</script><!-- note -->Tom &amp; Jerry'), 'Tom & Jerry')
+
+    def test_remove_html_script_after_non_ascii(self):
+        """Test script and style bodies are found after text that changes length when lower cased."""
+        self.assertEqual(tp.remove_html_tags('İ' * 16 + '<style>a{}</style>keep this'), \
+            'İ' * 16 + 'keep this')
+        self.assertEqual(tp.remove_html_tags('İ' * 8 + '<SCRIPT>x = 1</Script>keep this'), \
+            'İ' * 8 + 'keep this')
+
+    def test_remove_html_stray_brackets(self):
+        """Test that a '<' which doesn't start a tag is kept."""
+        self.assertEqual(tp.remove_html_tags('I <3 <b>you</b>'), 'I <3 you')
+
+    def test_remove_html_and_whitespace(self):
+        """Test stripping HTML and collapsing whitespace in one step."""
+        self.assertEqual(tp.remove_html_and_whitespace('<p>Hello  World</p><p>Hi \n There</p>'), \
+            'Hello World Hi There')
+
+    def test_remove_html_inline_tags(self):
+        """Test inline tags inside a word leave it whole, while block tags separate words."""
+        self.assertEqual(tp.remove_html_tags('Hel<b>lo</b> there'), 'Hello there')
+        self.assertEqual(tp.remove_html_and_whitespace('Hel<b>lo</b> there'), 'Hello there')
+        self.assertEqual(tp.remove_html_tags('<p>Hello</p><p>there</p><br/>'), 'Hello there')
+
     def test_remove_excess_whitespace(self):
         """Test removing excess white space."""
         self.assertEqual(tp.remove_excess_whitespace('Hello  World   From Gio \t\n\r\tHi There'), \
@@ -148,6 +319,29 @@ class test_textPreprocessing(unittest.TestCase):
         self.assertEqual(tp.split_contractions('I\'m wanting to test this.'), \
             'I am wanting to test this.')
 
+    def test_expand_contractions(self):
+        """Test the precompiled expansion matches contractions.fix, optionally keeping case."""
+        import contractions
+        utterance = 'DON\'T worry, it\'s fine. Y\'all wanna go on jan. 3? Shouldn\'t\'ve.'
+        self.assertEqual(tp.expand_contractions(utterance), contractions.fix(utterance))
+        self.assertEqual(tp.expand_contractions('DON\'T do it, It\'s', preserve_case=True), \
+            'DO NOT do it, It is')
+        self.assertEqual(tp.expand_contractions_batch(['I\'m here', 'no change']), \
+            ['I am here', 'no change'])
+
+    def test_split_standard_contractions(self):
+        """Test slang is left alone and abbreviations are found without apostrophes."""
+        pattern, table, unmarked_pattern, abbreviations = \
+            tp.contraction_matcher(leftovers=False, slang=False)
+        self.assertTrue(abbreviations)
+        self.assertFalse(tp.contraction_matcher()[3])
+        self.assertEqual(tp.split_standard_contractions('I dont wanna test this'), \
+            'I dont wanna test this')
+        self.assertEqual(tp.split_standard_contractions('I don\'t wanna test this'), \
+            'I do not wanna test this')
+        self.assertEqual(tp.split_standard_contractions('Due on Jan. 5. Sent in xjan.'), \
+            'Due on january 5. Sent in xjan.')
+
     def test_convert_emoticons(self):
         """Test converting emoticons to text representations."""
         self.assertEqual(tp.convert_emoticons('Hi! :D'), \
@@ -158,6 +352,154 @@ class test_textPreprocessing(unittest.TestCase):
         self.assertEqual(tp.convert_emojis('Hilarious 😂.'), \
             'Hilarious face with tears of joy.')
 
+    def test_convert_multiple_emoticons(self):
+        """Tests converting several emoticons in one utterance."""
+        self.assertEqual(tp.convert_emoticons('Hi :D and :P'), \
+            'Hi Laughing big grin or laugh with glasses and ' \
+            'Tongue sticking out cheeky playful or blowing a raspberry')
+
+    def test_convert_emojis_ascii(self):
+        """Tests that plain ASCII text passes through the emoji converter unchanged."""
+        self.assertEqual(tp.convert_emojis('Nothing to see here :)'), \
+            'Nothing to see here :)')
+
+    def test_text_cleaner(self):
+        """Tests the fused clean_text steps on a single utterance."""
+        clean = tp.text_cleaner()
+        self.assertEqual(clean('<p>Hola   cómo  estás</p>'), 'Hola como estas')
+
+    def test_no_text_steps(self):
+        """Tests that no fused function is built when every step is turned off."""
+        self.assertIsNone(tp.text_normaliser(
+            fix_spelling=False,
+            normalise_contractions=False,
+            normalise_emojis=False))
+
+    def test_result_cache(self):
+        """Tests that duplicates are only computed once and hits are counted."""
+        cache = tp.ResultCache(max_size=10)
+        calls = []
+        def compute(utterances):
+            calls.extend(utterances)
+            return [utterance.upper().split() for utterance in utterances]
+        results = cache.apply(compute, ['a b', 'c', 'a b'], 'config')
+        self.assertEqual(results, [['A', 'B'], ['C'], ['A', 'B']])
+        self.assertEqual(calls, ['a b', 'c'])
+        cache.apply(compute, ['c'], 'config')
+        self.assertEqual(calls, ['a b', 'c'])
+        cache.apply(compute, ['c'], 'other config')
+        self.assertEqual(calls, ['a b', 'c', 'c'])
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_cache_config(self):
+        """Tests cache configs change with the model, gazetteer files and memory settings."""
+        processor = tp.TextPreprocessing(self.test_utterances)
+        self.assertIn(processor.nlp.meta['version'], processor.cache_config()[2])
+        bounded = tp.TextPreprocessing(self.test_utterances, memory_limit=512)
+        self.assertNotEqual(bounded.cache_config(), processor.cache_config())
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'products.txt')
+            with open(path, 'w') as products:
+                products.write('widget pro\n')
+            digest = tp.Gazetteer.from_files(processor.nlp, {'PRODUCT': path}).digest
+            with open(path, 'a') as products:
+                products.write('widget max\n')
+            self.assertNotEqual(tp.Gazetteer.from_files(processor.nlp, {'PRODUCT': path}).digest, digest)
+        nlp = spacy.load('en_core_web_sm')
+        tp.add_nlp_pipes(nlp, ['entity_ruler'])
+        fingerprint = tp.model_fingerprint(nlp)
+        nlp.get_pipe('entity_ruler').add_patterns([{'label': 'ORG', 'pattern': 'Acme'}])
+        self.assertNotEqual(tp.model_fingerprint(nlp), fingerprint)
+
+    def test_preprocess_cached(self):
+        """Tests cache hits give the same tokens and cleaned text as an uncached run."""
+        test_phrases = ['<p>Tis iz a testing thingy. I\'m wantin to test. John ows me $200 >.<.   </p>']
+        uncached = tp.TextPreprocessing(test_phrases)
+        uncached.preprocess()
+        cache = tp.ResultCache()
+        for _ in range(2):
+            processor = tp.TextPreprocessing(test_phrases, cache=cache)
+            processor.preprocess()
+            self.assertEqual(processor.nlp_utterances, list(map(tp.tokens_to_text, uncached.nlp_utterances)))
+            self.assertEqual(processor.cleaned_utterances, uncached.cleaned_utterances)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_result_cache_copies(self):
+        """Tests that changing a returned result doesn't change the cached one."""
+        cache = tp.ResultCache()
+        compute = lambda utterances: [utterance.split() for utterance in utterances]
+        results = cache.apply(compute, ['a b', 'a b'], 'config')
+        results[0].append('changed')
+        self.assertEqual(results[1], ['a', 'b'])
+        cache.apply(compute, ['a b'], 'config')[0].append('changed')
+        self.assertEqual(cache.apply(compute, ['a b'], 'config'), [['a', 'b']])
+
+    def test_result_cache_eviction(self):
+        """Tests that the in-memory tier drops the least recently used result."""
+        cache = tp.ResultCache(max_size=2)
+        cache.set_many([('a', ['a']), ('b', ['b'])])
+        cache.get('a')
+        cache.set_many([('c', ['c'])])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), ['a'])
+
+    def test_result_cache_disk(self):
+        """Tests that results on disk survive a new cache."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite')
+            cache = tp.ResultCache(path=path)
+            cache.set_many([('key', ['some', 'tokens'])])
+            cache.close()
+            cache = tp.ResultCache(path=path)
+            self.assertEqual(cache.get('key'), ['some', 'tokens'])
+            self.assertEqual(cache.stats()['disk_hits'], 1)
+            cache.close()
+
+    def test_stage_profiler(self):
+        """Tests recording each fused step and passing the records to callbacks."""
+        records = []
+        profiler = tp.StageProfiler(callbacks=[lambda step, record: records.append(step)])
+        clean = tp.text_cleaner(drop_html=False, profiler=profiler)
+        clean('Hola   cómo estás')
+        clean('Hi  there')
+        profiler.flush()
+        self.assertEqual(records, ['remove_excess_whitespace', 'convert_non_ascii'])
+        self.assertEqual(profiler.totals['convert_non_ascii']['calls'], 2)
+        self.assertEqual(profiler.totals['remove_excess_whitespace']['tokens_out'], 5)
+
+    def test_profiled_filter_text(self):
+        """Tests that the SpaCy parse and token filters are recorded."""
+        processor = tp.TextPreprocessing(self.test_utterances, profiler=tp.StageProfiler())
+        processor.filter_text()
+        self.assertEqual(set(processor.profiler.totals), {'nlp.pipe', 'filter_tokens'})
+        self.assertEqual(processor.profiler.totals['filter_tokens']['tokens_out'], \
+            sum(map(len, processor.nlp_utterances)))
+
+    def test_token_arrays(self):
+        """Tests converting processed utterances to the compact array format."""
+        utterances = [['good', 'friend'], [], ['friend', 'DATE']]
+        arrays = tp.TokenArrays.from_utterances(utterances)
+        self.assertEqual(arrays.vocab, ['good', 'friend', 'DATE'])
+        self.assertEqual(list(arrays.token_ids), [0, 1, 1, 2])
+        self.assertEqual(list(arrays.offsets), [0, 2, 2, 4])
+        self.assertEqual(arrays.to_lists(), utterances)
+        self.assertEqual(arrays[-1], ['friend', 'DATE'])
+        with self.assertRaises(IndexError):
+            arrays[3]
+        with self.assertRaises(IndexError):
+            arrays[-4]
+        with self.assertRaises(ValueError):
+            tp.TextPreprocessing(self.test_utterances).to_arrays()
+
+    def test_token_arrays_save(self):
+        """Tests saving the compact array format and memory-mapping it back."""
+        utterances = [['good', 'friend'], ['friend', 'DATE']]
+        with tempfile.TemporaryDirectory() as directory:
+            tp.TokenArrays.from_utterances(utterances).save(directory)
+            arrays = tp.TokenArrays.load(directory)
+            self.assertEqual(arrays.to_lists(), utterances)
+            del arrays
+
     def test_norm_entity(self):
         """Tests normalising an entity."""
         self.preprocessor.nlp_utterances = None
@@ -234,5 +576,225 @@ class test_textPreprocessing(unittest.TestCase):
             else token for token in norm]
         self.assertEqual(norm_text, ['good', 'friend', 'DATE', 'come', 'CARDINAL'])
 
+    def test_preprocess_stream(self):
+        """Tests lazily preprocessing an iterable in small batches."""
+        test_phrases = (phrase for phrase in [
+            'Will is my best friend. last friday he came to give me $400!'] * 3)
+        processor = tp.TextPreprocessing([])
+        results = processor.preprocess_stream(test_phrases, batch_size=2)
+        norm_texts = [[token.text if isinstance(token, spacy.tokens.token.Token) \
+            else token for token in norm] for norm in results]
+        self.assertEqual(norm_texts, [['good', 'friend', 'DATE', 'come', 'CARDINAL']] * 3)
+
+    def test_preprocess_parallel(self):
+        """Tests preprocessing across several processes keeps the input order."""
+        test_phrases = [
+            'Will is my best friend. last friday he came to give me $400!',
+            '<p>Tis iz a testing thingy. I\'m wantin to test. John ows me $200 >.<.   </p>',
+        ] * 2
+        with tp.TextPreprocessing(test_phrases, n_process=2) as processor:
+            processor.preprocess(batch_size=1)
+        self.assertEqual(processor.nlp_utterances, [
+            ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+            ['testing', 'thingy', 'want', 'test', 'PERSON', 'CARDINAL'],
+        ] * 2)
+
+    def test_deduplicate(self):
+        """Tests grouping utterances that only differ in HTML, whitespace and case."""
+        uniques, positions = tp.deduplicate(['<p>Hi  there</p>', 'hi there', 'Bye', 'HI THERE '])
+        self.assertEqual(uniques, ['<p>Hi  there</p>', 'Bye'])
+        self.assertEqual(positions, [0, 0, 1, 0])
+
+    def test_preprocess_deduplicated(self):
+        """Tests duplicates are processed once and broadcast back in order."""
+        test_phrases = [
+            'Will is my best friend. last friday he came to give me $400!',
+            '<p>Tis iz a testing thingy. I\'m wantin to test. John ows me $200 >.<.   </p>',
+            'Will is my best friend.  last friday he came to give me $400!',
+        ]
+        processor = tp.TextPreprocessing(test_phrases, deduplicate=True, profiler=tp.StageProfiler())
+        processor.preprocess()
+        # Every utterance is cleaned once, and only the unique ones normalised
+        self.assertEqual(processor.profiler.totals['remove_html_and_whitespace']['calls'], 3)
+        self.assertEqual(processor.profiler.totals['convert_emoticons']['calls'], 2)
+        self.assertEqual(list(map(tp.tokens_to_text, processor.nlp_utterances)), [
+            ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+            ['testing', 'thingy', 'want', 'test', 'PERSON', 'CARDINAL'],
+            ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+        ])
+        self.assertEqual(processor.dedup_stats['unique'], 2)
+        self.assertAlmostEqual(processor.dedup_stats['dedup_ratio'], 1 / 3)
+
+        # Without drop_html the tags are kept, so tagged copies aren't duplicates
+        test_phrases = ['<b>Will</b> is my best friend.', 'Will is my best friend.']
+        processor = tp.TextPreprocessing(test_phrases, deduplicate=True,
+            spec=tp.PipelineSpec(drop_html=False))
+        processor.preprocess()
+        self.assertEqual(processor.dedup_stats['unique'], 2)
+
+        # Escaped tags decoded by the first clean aren't stripped by a second one
+        test_phrases = ['&lt;b&gt;Will&lt;/b&gt; is my best friend.']
+        processor = tp.TextPreprocessing(test_phrases, deduplicate=True)
+        processor.preprocess()
+        plain = tp.TextPreprocessing(test_phrases)
+        plain.preprocess()
+        self.assertEqual(list(map(tp.tokens_to_text, processor.nlp_utterances)), \
+            list(map(tp.tokens_to_text, plain.nlp_utterances)))
+        self.assertEqual(processor.cleaned_utterances, plain.cleaned_utterances)
+
+    def test_split_text(self):
+        """Tests splitting long texts at sentence ends and batching by characters."""
+        self.assertEqual(tp.split_text('One two. Three four five. Six', 12), \
+            ['One two. ', 'Three four ', 'five. Six'])
+        self.assertEqual(list(tp.char_batches(['aaa', 'bb', 'cccccc', 'd'], 5)), \
+            [['aaa', 'bb'], ['cccccc'], ['d']])
+
+    def test_memory_limit(self):
+        """Tests bounded-memory processing matches the default and keeps no docs."""
+        test_phrases = [
+            'Will is my best friend. last friday he came to give me $400!',
+            '<p>Tis iz a testing thingy. I\'m wantin to test. John ows me $200 >.<.   </p>',
+        ]
+        processor = tp.TextPreprocessing(test_phrases, memory_limit=1)
+        processor.preprocess()
+        self.assertEqual(processor.docs, None)
+        self.assertEqual(processor.nlp_utterances, [
+            ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+            ['testing', 'thingy', 'want', 'test', 'PERSON', 'CARDINAL'],
+        ])
+
+    def test_memory_limit_long_texts(self):
+        """Tests long texts are only cut to the memory budget, not the headroom left."""
+        # 20MB leaves a 2000 character budget, but the process is already using more
+        long_phrase = 'Will is my best friend. ' * 60
+        processor = tp.TextPreprocessing([long_phrase], memory_limit=20, long_texts='truncate')
+        processor.preprocess()
+        unbounded = tp.TextPreprocessing([long_phrase])
+        unbounded.preprocess()
+        self.assertEqual(processor.nlp_utterances, unbounded.nlp_utterances)
+        with self.assertRaises(ValueError):
+            tp.TextPreprocessing([long_phrase], memory_limit=20, long_texts='drop')
+
+    def test_pipeline_spec(self):
+        """Tests specs are hashable, picklable and round trip through dictionaries."""
+        import pickle
+        spec = tp.PipelineSpec(norm_ents=['PERSON', 'DATE'], drop_pos=['NOUN'])
+        self.assertEqual(spec, tp.PipelineSpec(norm_ents=['DATE', 'PERSON'], drop_pos=['NOUN']))
+        self.assertEqual(hash(spec), hash(tp.PipelineSpec.from_dict(spec.to_dict())))
+        self.assertEqual(pickle.loads(pickle.dumps(spec)), spec)
+        self.assertNotEqual(spec.replace(lemma=False), spec)
+        with self.assertRaises(AttributeError):
+            spec.lemma = False
+        with self.assertRaises(ValueError):
+            tp.PipelineSpec(drop_stopwords=True)
+        self.assertEqual(tp.PipelineSpec(drop_ent='PERSON').drop_ent, ('PERSON',))
+        self.assertEqual(tp.PipelineSpec(pipes='sentencizer').pipes, ('sentencizer',))
+
+    def test_pipeline(self):
+        """Tests a compiled pipeline matches preprocess() on corpora and single strings."""
+        test_phrases = [
+            'Will is my best friend. last friday he came to give me $400!',
+            '<p>Tis iz a testing thingy. I\'m wantin to test. John ows me $200 >.<.   </p>',
+        ]
+        pipeline = tp.PipelineSpec().compile()
+        self.assertIs(pipeline, tp.PipelineSpec().compile())
+        expected = [
+            ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+            ['testing', 'thingy', 'want', 'test', 'PERSON', 'CARDINAL'],
+        ]
+        self.assertEqual(pipeline.process(test_phrases), expected)
+        self.assertEqual(pipeline(test_phrases[0]), expected[0])
+
+    def test_gazetteer(self):
+        """Tests tagging gazetteer phrases as entities to remove, and caching the gazetteer."""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'products.txt')
+            with open(path, 'w') as products:
+                products.write('Acme Turbo 3000\nwidget pro\n\n')
+            cache = os.path.join(directory, 'cache')
+            spec = tp.PipelineSpec(gazetteers={'PRODUCT': path}, gazetteer_cache=cache,
+                fix_spelling=False, drop_stop_words=False, drop_ent=['PRODUCT'],
+                norm_ents=None, lemma=False)
+            pipeline = spec.compile()
+            # The model, and with it the gazetteer, only loads when first used
+            self.assertEqual(pipeline.nlp.pipe_names[-1], tp.Gazetteer.name)
+            self.assertEqual(len(os.listdir(cache)), 1)
+            cached = tp.Gazetteer.from_files(pipeline.nlp, {'PRODUCT': path}, cache_dir=cache)
+            self.assertEqual(len(cached), 2)
+        self.assertEqual(pipeline('I bought an ACME turbo 3000 and a Widget Pro'), \
+            ['I', 'bought', 'an', 'and', 'a'])
+
+    def test_worker_pool_reuse(self):
+        """Tests every batch of a stream goes to the same worker pool until close()."""
+        test_phrases = ['Will is my best friend. last friday he came to give me $400!'] * 4
+        with tp.TextPreprocessing([], n_process=2) as processor:
+            results = processor.preprocess_stream(test_phrases, batch_size=2)
+            self.assertEqual(next(results), ['good', 'friend', 'DATE', 'come', 'CARDINAL'])
+            pool = processor.workers.pool
+            self.assertEqual(len(list(results)), 3)
+            self.assertIs(processor.workers.pool, pool)
+            self.assertIn(processor.workers, tp.running_worker_pools)
+        self.assertIsNone(processor.workers.pool)
+        self.assertNotIn(processor.workers, tp.running_worker_pools)
+
+    def test_close_worker_pools(self):
+        """Tests workers of compiled pipelines are shut down by close_worker_pools at exit."""
+        pipeline = tp.PipelineSpec().compile()
+        pipeline.process(['This is a testing sentence.'] * 2, batch_size=1, n_process=2)
+        self.assertIn(pipeline.workers, tp.running_worker_pools)
+        tp.close_worker_pools()
+        self.assertIsNone(pipeline.workers.pool)
+
+    def test_async_preprocessor(self):
+        """Tests micro-batching concurrent requests through the async front end."""
+        test_phrases = [
+            'Will is my best friend. last friday he came to give me $400!',
+            '<p>Tis iz a testing thingy. I\'m wantin to test. John ows me $200 >.<.   </p>',
+        ] * 2
+        async def preprocess_all():
+            async with tp.AsyncPreprocessor(max_batch_size=3) as preprocessor:
+                return await asyncio.gather(*map(preprocessor.preprocess, test_phrases))
+        self.assertEqual(asyncio.run(preprocess_all()), [
+            ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+            ['testing', 'thingy', 'want', 'test', 'PERSON', 'CARDINAL'],
+        ] * 2)
+
+    def test_async_preprocessor_close(self):
+        """Tests closing still answers requests that are queued, batching or waiting for room."""
+        async def close_while_queued():
+            preprocessor = tp.AsyncPreprocessor(max_batch_size=4, max_wait=10, max_pending=1)
+            requests = [asyncio.ensure_future(preprocessor.preprocess('John is a common name.')) \
+                for _ in range(7)]
+            await asyncio.sleep(0.1)
+            await preprocessor.close()
+            return await asyncio.wait_for(asyncio.gather(*requests), 5)
+        results = asyncio.run(close_while_queued())
+        self.assertEqual(len(results), 7)
+        self.assertEqual(results, [results[0]] * 7)
+
+    def test_async_preprocessor_errors(self):
+        """Tests a bad request fails on its own without failing the rest of its batch."""
+        async def preprocess_mixed():
+            async with tp.AsyncPreprocessor(max_wait=0.1) as preprocessor:
+                return await asyncio.gather(preprocessor.preprocess(None),
+                    preprocessor.preprocess('John is a common name.'), return_exceptions=True)
+        error, result = asyncio.run(preprocess_mixed())
+        self.assertIsInstance(error, TypeError)
+        processor = tp.TextPreprocessing(['John is a common name.'])
+        processor.preprocess()
+        self.assertEqual(result, tp.tokens_to_text(processor.nlp_utterances[0]))
+
+    def test_async_preprocessor_specs(self):
+        """Tests preprocessors running in threads each keep their own spec."""
+        phrase = 'Will is my best friend. last friday he came to give me $400!'
+        async def preprocess_both():
+            async with tp.AsyncPreprocessor() as lemmatised, \
+                tp.AsyncPreprocessor(spec=tp.PipelineSpec(lemma=False)) as unlemmatised:
+                return await asyncio.gather(lemmatised.preprocess(phrase), unlemmatised.preprocess(phrase))
+        self.assertEqual(asyncio.run(preprocess_both()), [
+            ['good', 'friend', 'DATE', 'come', 'CARDINAL'],
+            ['best', 'friend', 'DATE', 'came', 'CARDINAL'],
+        ])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file